@@ -0,0 +1,84 @@
+import os
+import json
+import hashlib
+
+from processing.json_utils import write_json_atomic
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def checksum_file(file_path):
+    """Returns the md5 hex digest of a file, read in 8MB blocks."""
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def load_manifest(process_dir):
+    """Loads the manifest of a chunk directory, or returns None if there isn't a readable one."""
+    try:
+        with open(os.path.join(process_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def save_manifest(process_dir, manifest):
+    """Writes the manifest of a chunk directory."""
+    write_json_atomic(os.path.join(process_dir, MANIFEST_NAME), manifest, indent=1)
+
+
+def new_manifest(process_dir, chunk):
+    """Creates the manifest for a freshly claimed chunk."""
+    manifest = {'chunk': chunk, 'stages': {}}
+    save_manifest(process_dir, manifest)
+    return manifest
+
+
+def mark_stage_completed(process_dir, chunk, stage, sub_dirs):
+    """ records a stage as completed, along with the checksum of every file in sub_dirs
+    (relative to process_dir) and the current chunk state, so it can be resumed from here
+    """
+    manifest = load_manifest(process_dir) or {'stages': {}}
+
+    checksums = {}
+    for sub_dir in sub_dirs:
+        full_dir = os.path.join(process_dir, sub_dir)
+        if not os.path.isdir(full_dir):
+            continue
+        for file_name in sorted(os.listdir(full_dir)):
+            file_path = os.path.join(full_dir, file_name)
+            if os.path.isfile(file_path):
+                checksums[os.path.join(sub_dir, file_name)] = checksum_file(file_path)
+
+    # underscored keys hold in-memory state, such as encoded tiles, which isn't kept across runs
+    manifest['chunk'] = {key: value for key, value in chunk.items() if not key.startswith('_')}
+    manifest['stages'][stage] = checksums
+    save_manifest(process_dir, manifest)
+
+
+def stage_intact(process_dir, manifest, stage):
+    """Checks a stage was completed and that all the files it recorded are unchanged."""
+    if stage not in manifest['stages']:
+        return False
+
+    for relative_path, checksum in manifest['stages'][stage].items():
+        file_path = os.path.join(process_dir, relative_path)
+        if not os.path.isfile(file_path) or checksum_file(file_path) != checksum:
+            print(f"Checkpoint for {stage} is stale - {relative_path} is missing or changed")
+            return False
+
+    return True
+
+
+def last_good_stage(process_dir, manifest, stages):
+    """ returns the index of the last stage in stages which can be trusted on resume, or -1.
+    we walk back from the end, so a verified late stage means the earlier ones are not needed
+    """
+    for index in range(len(stages) - 1, -1, -1):
+        if stage_intact(process_dir, manifest, stages[index]):
+            return index
+    return -1
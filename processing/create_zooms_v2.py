@@ -1,4 +1,5 @@
 from PIL import Image
+import numpy as np
 import os
 import io
 import math
@@ -7,11 +8,53 @@ import concurrent.futures
 import requests
 import json
 
+from processing.dirty_tiles import ZOOMS, DirtyTiles
+from processing.palette_utils import ZOOM_PALETTE, palette_image
+
 s3 = boto3.client('s3')
 
+# how parents are downsampled from their 64 children - 'fast' averages each 8x8 block of pixels with numpy,
+# 'balanced' averages 2x2 blocks then finishes with LANCZOS, 'quality' is LANCZOS all the way down
+DOWNSAMPLE_PRESETS = {'fast': 8, 'balanced': 2, 'quality': 1}
+DOWNSAMPLE_PRESET = 'fast'
+
+# how zoom tiles are quantised - 'fixed' maps every pixel onto the shared ZOOM_PALETTE through a cached lookup
+# table, so neighbouring tiles never shimmer between palettes, 'adaptive' searches a 32 colour palette per tile
+QUANTIZER = 'fixed'
+
 # Join tiles function
-def join_tiles(images_xy, offset_x, offset_y):
+def join_tiles(images_xy, offset_x, offset_y, preset=DOWNSAMPLE_PRESET):
     """Combine 64 tiles (8x8 grid) into a single image and resize."""
+    if preset == 'quality':
+        return join_tiles_lanczos(images_xy, offset_x, offset_y)
+
+    # decode straight into a preallocated array, rather than pasting into a PIL canvas
+    canvas = np.full((offset_y * 8, offset_x * 8, 3), 255, dtype=np.uint8)
+    for x, row in images_xy.items():
+        for y, img_bytes in row.items():
+            try:
+                open_tile = Image.open(io.BytesIO(img_bytes))
+                if open_tile.size[0] > 470 and open_tile.size[1] > 470:
+                    pixels = np.asarray(open_tile.convert('RGB'))[:offset_y, :offset_x]
+                    canvas[y * offset_y:y * offset_y + pixels.shape[0], x * offset_x:x * offset_x + pixels.shape[1]] = pixels
+            except Exception:
+                continue
+
+    return downsample(canvas, offset_x, offset_y, DOWNSAMPLE_PRESETS[preset])
+
+def downsample(canvas, width, height, box):
+    """ area averages the canvas over box x box blocks with a reshape and mean, then resizes whatever
+    is left to width x height with LANCZOS
+    """
+    rows, cols = canvas.shape[0] // box, canvas.shape[1] // box
+    reduced = canvas.reshape(rows, box, cols, box, 3).mean(axis=(1, 3), dtype=np.float32)
+    image = Image.fromarray(np.round(reduced).astype(np.uint8), 'RGB')
+    if image.size != (width, height):
+        image = image.resize((width, height), Image.LANCZOS)
+    return image
+
+def join_tiles_lanczos(images_xy, offset_x, offset_y):
+    """Combine 64 tiles (8x8 grid) into a single image and resize with LANCZOS - the 'quality' preset."""
     new_tile = Image.new("RGB", (offset_x * 8, offset_y * 8), (255, 255, 255))
 
     for x, row in images_xy.items():
@@ -36,15 +79,41 @@ def download_tile(zoom, x, y):
         return None
 
 # Upload tiles in parallel
+def quantize_tile(image, quantizer=QUANTIZER):
+    """Quantise a tile to 8 bits, falling back to the adaptive quantiser if the fixed palette can't be used."""
+    if quantizer == 'fixed':
+        try:
+            return palette_image(np.asarray(image.convert('RGB')), ZOOM_PALETTE)
+        except Exception as e:
+            print(f'Fixed palette quantisation failed, falling back to adaptive: {e}')
+    return image.quantize(colors=32, method=2)
+
 def upload_tile(zoom, x, y, image):
-    """Upload processed tile to S3."""
+    """Upload processed tile to S3, return the png bytes uploaded."""
     file_stream = io.BytesIO()
-    image.quantize(colors=32, method=2).save(file_stream, format='PNG')
+    quantize_tile(image).save(file_stream, format='PNG')
     key = f'tiles/{zoom}/{x}/{y}.png'
     s3.put_object(Body=file_stream.getvalue(), Bucket='nzomap', Key=key)
+    return file_stream.getvalue()
+
+def remove_tile(zoom, x, y):
+    """Delete a tile from S3, if there is one."""
+    s3.delete_object(Bucket='nzomap', Key=f'tiles/{zoom}/{x}/{y}.png')
 
 # Main processing function
-def main(in_x, in_y):
+def main(in_x, in_y, empty_tiles=(), changed_tiles=None):
+    """ rebuilds the zoom 12 to 0 tiles over the chunk at in_x, in_y.
+    empty_tiles are the z15 (x, y) tiles the worker left out for being entirely nodata - they are never
+    fetched, so a stale copy from an earlier run can't leak into the parents.
+    changed_tiles, the z15 keys the worker actually uploaded, limits the rebuild to their parents
+    """
+    if changed_tiles is not None:
+        dirty = DirtyTiles()
+        dirty.add(changed_tiles)
+        rebuild_dirty(dirty, empty_tiles=empty_tiles)
+        return
+
+    empty_tiles = {tuple(tile) for tile in empty_tiles}
 
     for zoom in [12, 9, 6, 3, 0]:
         parents = {}
@@ -58,7 +127,8 @@ def main(in_x, in_y):
 
         # Use ThreadPoolExecutor for parallel tile downloading
         with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {executor.submit(download_tile, zoom, x, y): (x, y) for x in range(x_min, x_max) for y in range(y_min, y_max)}
+            futures = {executor.submit(download_tile, zoom, x, y): (x, y) for x in range(x_min, x_max) for y in range(y_min, y_max)
+                       if zoom != 12 or (x, y) not in empty_tiles}
             
             for future in concurrent.futures.as_completed(futures):
                 result = future.result()
@@ -85,6 +155,67 @@ def main(in_x, in_y):
 
 
 
+def rebuild_dirty(dirty, tiles=None, empty_tiles=(), workers=10):
+    """ rebuilds only the parents in a DirtyTiles set, bottom up, each exactly once.
+    tiles are z15 tiles already in memory, {(x, y): png bytes}, and each level is built from the one below
+    it still in memory - so only the children that aren't held are fetched from S3.
+    children are fetched per parent as it is built, so only the parents in flight hold theirs, and only
+    the built parents are kept for the next zoom - memory stays flat however large the dirty set is.
+    empty_tiles are z15 (x, y) tiles left out for being entirely nodata, which are never fetched.
+    a dirty parent left with no children at all is deleted, and treated as absent by the zoom above it
+    """
+    absent = {tuple(tile) for tile in empty_tiles}
+    children = dict(tiles or {})
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as fetch_executor:
+        for zoom in ZOOMS:
+            def build(key):
+                x_parent, y_parent = key
+                images_xy = {}
+                missing = []
+                for x in range(x_parent * 8, x_parent * 8 + 8):
+                    for y in range(y_parent * 8, y_parent * 8 + 8):
+                        if (x, y) in children:
+                            images_xy.setdefault(x % 8, {})[y % 8] = children[(x, y)]
+                        elif (x, y) not in absent:
+                            missing.append((x, y))
+
+                for result in fetch_executor.map(lambda xy: download_tile(zoom, *xy), missing):
+                    if result:
+                        x, y, file_body = result
+                        images_xy.setdefault(x % 8, {})[y % 8] = file_body
+
+                if not images_xy:
+                    # everything under it is gone, so a published copy would only be stale
+                    remove_tile(zoom, x_parent, y_parent)
+                    return key, None, len(missing)
+                return key, upload_tile(zoom, x_parent, y_parent, join_tiles(images_xy, 474, 474)), len(missing)
+
+            built = {}
+            removed = set()
+            fetched = 0
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for key, file_body, missing_count in executor.map(build, dirty.zooms[zoom]):
+                    fetched += missing_count
+                    if file_body is not None:
+                        built[key] = file_body
+                    else:
+                        removed.add(key)
+            children = built
+            absent = removed
+
+            print(f'Built {len(children)} tiles at zoom {zoom}, fetched up to {fetched} children')
+
+def build_zooms(tiles, empty_tiles=(), workers=10, changed_tiles=None):
+    """ builds zoom 12 to 0 for a chunk straight from its freshly made z15 tiles, {(x, y): png bytes},
+    rather than downloading them again. only the parents of changed_tiles (positions or keys) are
+    rebuilt if given, otherwise those of every tile
+    """
+    dirty = DirtyTiles()
+    dirty.add(tiles if changed_tiles is None else changed_tiles)
+    rebuild_dirty(dirty, tiles, empty_tiles, workers)
+
+
 if __name__ == "__main__":
 
     r = requests.post('https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/create_zoom_tiles')
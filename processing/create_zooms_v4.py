@@ -7,9 +7,21 @@ import concurrent.futures
 import requests
 import json
 
+from processing.create_zooms_v2 import rebuild_dirty
+from processing.dirty_tiles import DirtyTiles
+
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table('ProcessingAreasV2')
 
+# set to True to rebuild the zooms for every pending chunk on this machine in one pass, rather than a lambda per chunk
+BATCH_ZOOMS = False
+
+# threads building parent tiles in batch mode - decoding, downsampling and encoding mostly release the GIL
+BATCH_WORKERS = (os.cpu_count() or 4) * 2
+
+# the dirty set is kept here while a batch runs, so an interrupted batch is folded into the next one
+DIRTY_PATH = 'dirty_zooms.json'
+
 
 def main(area_name):
     # Get all tiles for area from DynamoDB
@@ -51,7 +63,70 @@ def main(area_name):
                 )
 
 
+def mark_tiled(attributes):
+    """ marks a chunk as tiled in ProcessingAreasV2 - attributes are the chunk's item attributes in DynamoDB
+    form, which must include the table's key. a chunk missing from the table is never created
+    """
+    key_names = [key['AttributeName'] for key in table.key_schema]
+    boto3.client('dynamodb').update_item(
+        TableName='ProcessingAreasV2',
+        Key={name: attributes[name] for name in key_names},
+        UpdateExpression='SET tiled = :tiled',
+        ConditionExpression='attribute_exists(processed)',
+        ExpressionAttributeValues={':tiled': {'BOOL': True}}
+    )
+
+
+def pending_items(area_name):
+    """Yields the DynamoDB items of an area's chunks which have been processed but not tiled."""
+    client = boto3.client('dynamodb')
+    paginator = client.get_paginator('query')
+    operation_parameters = {
+        'TableName': 'ProcessingAreasV2',
+        'KeyConditionExpression': 'lidar_dataset = :area_name',
+        'ExpressionAttributeValues': {
+            ':area_name': {'S': area_name}
+        }
+    }
+
+    for page in paginator.paginate(**operation_parameters):
+        for item in page['Items']:
+            if item['processed']['BOOL'] and not item['tiled']['BOOL']:
+                yield item
+
+
+def chunk_z15_tiles(xmin, ymin):
+    """Returns the z15 (x, y) positions of the 25x25 tiles of the 5km chunk at xmin, ymin."""
+    return [(x // 200, (6553600 - y) // 200) for x in range(xmin, xmin + 5000, 200) for y in range(ymin, ymin + 5000, 200)]
+
+
+def main_batch(area_names, workers=BATCH_WORKERS, dirty_path=DIRTY_PATH):
+    """ batch version of main - gathers every pending chunk of the areas into one dirty set, so each
+    parent tile shared between chunks is rebuilt exactly once, bottom up, on a local pool of workers
+    threads rather than racing between lambdas. the chunks are marked tiled once the rebuild is done
+    """
+    dirty = DirtyTiles.load(dirty_path)
+    items = []
+    for area_name in area_names:
+        for item in pending_items(area_name):
+            dirty.add(chunk_z15_tiles(int(item['xmin']['N']), int(item['ymin']['N'])))
+            items.append(item)
+    print(f'Rebuilding {len(dirty)} parent tiles for {len(items)} chunks')
+
+    # saved before the rebuild, so a crash part way through doesn't lose the chunks' parents
+    dirty.save(dirty_path)
+    rebuild_dirty(dirty, workers=workers)
+
+    for item in items:
+        mark_tiled(item)
+    os.remove(dirty_path)
+    print(f'Marked {len(items)} chunks as tiled')
+
+
 if __name__ == "__main__":
     area_name = 'Central_South'
 
-    main(area_name)
+    if BATCH_ZOOMS:
+        main_batch([area_name])
+    else:
+        main(area_name)
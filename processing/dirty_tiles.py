@@ -0,0 +1,57 @@
+import json
+
+from processing.json_utils import write_json_atomic
+
+
+# zoom levels built from the z15 tiles, bottom up - each is 8x8 tiles of the one before it
+ZOOMS = [12, 9, 6, 3, 0]
+
+
+def tile_position(tile):
+    """Returns the (x, y) of a tile given either as a position or as its key, eg tiles/15/x/y.png."""
+    if isinstance(tile, str):
+        x, y = tile.replace('.png', '').split('/')[-2:]
+        return int(x), int(y)
+    return int(tile[0]), int(tile[1])
+
+
+class DirtyTiles:
+    """ the parent tiles at each zoom which need rebuilding because z15 tiles under them changed.
+    changed tiles are propagated up every zoom as they are added, and each set is deduplicated, so any
+    number of chunks can be folded into one set and every affected parent rebuilt exactly once
+    """
+
+    def __init__(self):
+        self.zooms = {zoom: set() for zoom in ZOOMS}
+
+    def add(self, tiles):
+        """Marks the parents of changed z15 tiles (positions or keys) as dirty at every zoom."""
+        positions = {tile_position(tile) for tile in tiles}
+        for zoom in ZOOMS:
+            positions = {(x // 8, y // 8) for x, y in positions}
+            self.zooms[zoom] |= positions
+
+    def update(self, other):
+        """Folds another dirty set into this one."""
+        for zoom in ZOOMS:
+            self.zooms[zoom] |= other.zooms[zoom]
+
+    def __len__(self):
+        return sum(len(parents) for parents in self.zooms.values())
+
+    def save(self, path):
+        """Writes the dirty set to path."""
+        write_json_atomic(path, {str(zoom): sorted(parents) for zoom, parents in self.zooms.items()})
+
+    @classmethod
+    def load(cls, path):
+        """Loads a saved dirty set, or returns an empty one if there isn't a readable file."""
+        dirty = cls()
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except Exception:
+            return dirty
+        for zoom, parents in data.items():
+            dirty.zooms[int(zoom)] |= {tuple(parent) for parent in parents}
+        return dirty
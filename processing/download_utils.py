@@ -0,0 +1,171 @@
+import asyncio
+import os
+import time
+import struct
+import functools
+import concurrent.futures
+from boto3.s3.transfer import TransferConfig
+
+from processing.lidar_cache import link_or_copy
+
+
+LIDAR_BUCKET = 'pc-bulk'
+LIDAR_URL_PREFIX = 'https://opentopography.s3.sdsc.edu/pc-bulk/'
+
+MB = 1024 * 1024
+
+# the blocking S3 calls of each batch (here and in upload_utils) run on a thread pool sized to its concurrency,
+# as the default executor is smaller than that and shared by the downloads, uploads and tiling
+
+# large LAZ files are split into ranged GETs which run in parallel, small LAX files go in one request
+LAZ_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=32 * MB,
+    multipart_chunksize=16 * MB,
+    max_concurrency=8,
+    use_threads=True,
+)
+
+
+def lidar_key(url):
+    """Converts an OpenTopography url from the file list into a key in the pc-bulk bucket."""
+    return url.replace(LIDAR_URL_PREFIX, '')
+
+
+# the public LAS header (shared by LAZ files, as it isn't compressed) is 227 bytes in LAS 1.0-1.2,
+# and the bounding box always sits at the same offset
+LAS_HEADER_BYTES = 227
+LAS_BOUNDS_OFFSET = 179
+
+
+def read_las_extent(s3_client, url):
+    """ range GETs just the header of a LAS/LAZ file (blocking) and returns its point extent as
+    (min_x, min_y, max_x, max_y), or None if the header can't be read
+    """
+    try:
+        response = s3_client.get_object(Bucket=LIDAR_BUCKET, Key=lidar_key(url), Range=f'bytes=0-{LAS_HEADER_BYTES - 1}')
+        header = response['Body'].read()
+    except Exception as e:
+        print(f"Failed to read header of {url}: {e}")
+        return None
+
+    return parse_las_extent(header)
+
+
+def parse_las_extent(header):
+    """Returns (min_x, min_y, max_x, max_y) from the bytes of a LAS header, or None if it isn't one."""
+    if len(header) < LAS_HEADER_BYTES or header[:4] != b'LASF':
+        return None
+
+    max_x, min_x, max_y, min_y = struct.unpack_from('<4d', header, LAS_BOUNDS_OFFSET)
+    return min_x, min_y, max_x, max_y
+
+
+async def prune_lidar_files(s3_client, urls, bounds, margin, concurrency):
+    """ probes the header of every LAZ file in urls and drops those whose points don't come within
+    margin metres of bounds (xmin, ymin, xmax, ymax), along with their LAX files.
+    files whose header can't be read are kept. returns (kept urls, {laz url: extent})
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    laz_urls = [url for url in urls if url.lower().endswith('.laz')]
+    loop = asyncio.get_running_loop()
+
+    async def probe(url):
+        async with semaphore:
+            return url, await loop.run_in_executor(executor, read_las_extent, s3_client, url)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        extents = dict(await asyncio.gather(*[probe(url) for url in laz_urls]))
+
+    skipped = set()
+    for url, extent in extents.items():
+        if extent is None:
+            continue
+        min_x, min_y, max_x, max_y = extent
+        if max_x < bounds[0] - margin or min_x > bounds[2] + margin or max_y < bounds[1] - margin or min_y > bounds[3] + margin:
+            skipped.add(url)
+            skipped.add(url[:-1] + 'x')
+
+    if skipped:
+        print(f"Skipping {len([url for url in laz_urls if url in skipped])}/{len(laz_urls)} LAZ files which don't intersect the chunk")
+
+    kept = [url for url in urls if url not in skipped]
+    return kept, {url: extent for url, extent in extents.items() if url not in skipped}
+
+
+def download_lidar_file(s3_client, url, dest_dir, transfer_config=LAZ_TRANSFER_CONFIG, cache=None):
+    """ downloads a single lidar file (blocking), returns (file_name, bytes fetched, seconds).
+    with a cache, the file is linked from the cache when its ETag matches, otherwise it is
+    downloaded into the cache first - bytes fetched is 0 for a cache hit. a file another download is
+    already fetching into the cache is waited for, rather than fetched twice into the same part file
+    """
+    file_name = os.path.basename(url)
+    dest_path = os.path.join(dest_dir, file_name)
+    key = lidar_key(url)
+
+    start = time.monotonic()
+    if cache is None:
+        s3_client.download_file(LIDAR_BUCKET, key, dest_path, Config=transfer_config)
+        return file_name, os.path.getsize(dest_path), time.monotonic() - start
+
+    head = s3_client.head_object(Bucket=LIDAR_BUCKET, Key=key)
+    etag, size = head['ETag'].strip('"'), head['ContentLength']
+
+    cached_path = cache.lookup(key, etag)
+    if cached_path is not None:
+        link_or_copy(cached_path, dest_path)
+        return file_name, 0, time.monotonic() - start
+
+    part_path = cache.reserve(key, etag, size)
+    if part_path is None:
+        s3_client.download_file(LIDAR_BUCKET, key, dest_path, Config=transfer_config)
+        return file_name, size, time.monotonic() - start
+
+    try:
+        s3_client.download_file(LIDAR_BUCKET, key, part_path, Config=transfer_config)
+    except Exception:
+        cache.release(part_path, size)
+        raise
+    link_or_copy(cache.commit(key, etag, part_path, size), dest_path)
+    return file_name, size, time.monotonic() - start
+
+
+async def download_lidar_files(s3_client, urls, dest_dir, concurrency, transfer_config=LAZ_TRANSFER_CONFIG, cache=None, on_downloaded=None):
+    """ downloads lidar files from the pc-bulk bucket, running concurrency files at once, through the cache if given.
+    each download runs on a thread pool of its own so the event loop stays responsive, and throughput
+    is reported per file and for the whole batch. Failed files are reported and skipped.
+    on_downloaded, if given, is awaited with each file name as soon as that file has landed.
+    returns the list of file names downloaded
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    downloaded = []
+    total_bytes = 0
+
+    async def download(url):
+        nonlocal total_bytes
+        async with semaphore:
+            try:
+                file_name, size, elapsed = await loop.run_in_executor(
+                    executor, functools.partial(download_lidar_file, s3_client, url, dest_dir, transfer_config, cache)
+                )
+            except Exception as e:
+                print(f"Failed to download {url}: {e}")
+                return
+
+        downloaded.append(file_name)
+        total_bytes += size
+        if size == 0:
+            print(f"Linked {file_name} from the lidar cache")
+        else:
+            print(f"Downloaded {file_name} - {size / MB:.1f}MB in {elapsed:.1f}s ({size / MB / max(elapsed, 0.001):.1f}MB/s)")
+
+        if on_downloaded is not None:
+            await on_downloaded(file_name)
+
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        await asyncio.gather(*[download(url) for url in urls])
+    elapsed = time.monotonic() - start
+
+    print(f"Downloaded {len(downloaded)}/{len(urls)} files - {total_bytes / MB:.1f}MB in {elapsed:.1f}s ({total_bytes / MB / max(elapsed, 0.001):.1f}MB/s)")
+    return downloaded
@@ -0,0 +1,9 @@
+import os
+import json
+
+
+def write_json_atomic(path, data, indent=None):
+    """Writes data as json to path atomically, so a crash mid-write never leaves a half written file."""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=indent)
+    os.replace(path + '.tmp', path)
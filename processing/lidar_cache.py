@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+from processing.json_utils import write_json_atomic
+
+
+INDEX_NAME = 'index.json'
+
+
+def link_or_copy(src_path, dest_path):
+    """Hardlinks src_path to dest_path, falling back to a copy when they are on different filesystems."""
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        shutil.copyfile(src_path, dest_path)
+
+
+class LidarCache:
+    """ content addressed cache of lidar files, shared across chunks.
+    entries are keyed by bucket path plus ETag, so a changed source file is never served stale,
+    and the least recently used entries are evicted to keep the cache under budget_bytes.
+    chunks hardlink files out of the cache, so an evicted file stays valid for a chunk still using it.
+    """
+
+    def __init__(self, cache_dir, budget_bytes):
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+        self.lock = threading.Lock()
+        self.pending_bytes = 0  # space reserved for downloads still in progress
+        self.in_flight = {}  # entry name: event set once its download is committed or released
+        os.makedirs(cache_dir, exist_ok=True)
+
+        try:
+            with open(os.path.join(cache_dir, INDEX_NAME)) as f:
+                self.index = json.load(f)
+        except Exception:
+            self.index = {}
+
+        # drop index entries whose file has gone, and files (eg partial downloads) the index doesn't know
+        self.index = {name: entry for name, entry in self.index.items() if os.path.isfile(os.path.join(cache_dir, name))}
+        for name in os.listdir(cache_dir):
+            if name != INDEX_NAME and name not in self.index:
+                os.remove(os.path.join(cache_dir, name))
+        self._save_index()
+
+    def _save_index(self):
+        write_json_atomic(os.path.join(self.cache_dir, INDEX_NAME), self.index)
+
+    def entry_name(self, key, etag):
+        """Returns the cache file name for a bucket path and ETag."""
+        digest = hashlib.sha1(f"{key}:{etag}".encode('utf-8')).hexdigest()
+        return digest + os.path.splitext(key)[1]
+
+    def lookup(self, key, etag):
+        """ returns the cached path for key/etag and marks it as recently used, or None on a miss.
+        if the entry is being downloaded by another caller, waits for that download to finish first
+        """
+        name = self.entry_name(key, etag)
+        with self.lock:
+            downloading = self.in_flight.get(name)
+        if downloading is not None:
+            downloading.wait()
+        with self.lock:
+            if name not in self.index:
+                return None
+            self.index[name]['last_used'] = time.time()
+            self._save_index()
+        return os.path.join(self.cache_dir, name)
+
+    def reserve(self, key, etag, size):
+        """ makes room for a new entry of size bytes and returns the temporary path to download it to,
+        or None if it shouldn't be cached - the file is larger than the whole budget, or another caller
+        is already downloading it into the cache
+        """
+        if size > self.budget_bytes:
+            return None
+        name = self.entry_name(key, etag)
+        with self.lock:
+            if name in self.in_flight:
+                return None
+            self.in_flight[name] = threading.Event()
+            self._evict(size)
+            self.pending_bytes += size
+        return os.path.join(self.cache_dir, name + '.part')
+
+    def commit(self, key, etag, part_path, size):
+        """Moves a completed download into the cache and returns its cached path."""
+        name = self.entry_name(key, etag)
+        cached_path = os.path.join(self.cache_dir, name)
+        os.replace(part_path, cached_path)
+        with self.lock:
+            self.pending_bytes -= size
+            self.index[name] = {'key': key, 'etag': etag, 'size': os.path.getsize(cached_path), 'last_used': time.time()}
+            self._save_index()
+            self.in_flight.pop(name).set()
+        return cached_path
+
+    def release(self, part_path, size):
+        """Gives back the space reserved for a download that failed."""
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        with self.lock:
+            self.pending_bytes -= size
+            self.in_flight.pop(os.path.basename(part_path)[:-len('.part')]).set()
+
+    def _evict(self, incoming_bytes):
+        """Removes least recently used entries until incoming_bytes fits in the budget - must hold the lock."""
+        used = sum(entry['size'] for entry in self.index.values()) + self.pending_bytes
+        for name, entry in sorted(self.index.items(), key=lambda item: item[1]['last_used']):
+            if used + incoming_bytes <= self.budget_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            used -= entry['size']
+            del self.index[name]
+        self._save_index()
@@ -0,0 +1,89 @@
+import io
+import functools
+import numpy as np
+from PIL import Image
+
+
+# the colours pullauta renders the map with - the ISOM 2017 symbol set it draws from, plus the grey of its
+# undergrowth and the pale blue of marsh. every pixel of a tile is mapped to the nearest of these
+ISOM_PALETTE = (
+    (255, 255, 255),  # white - runnable forest, and nodata
+    (0, 0, 0),        # black - cliffs, boulders, buildings
+    (166, 83, 0),     # brown - contours
+    (210, 140, 70),   # light brown - depressions, formlines
+    (255, 186, 53),   # yellow - open land
+    (255, 221, 154),  # light yellow - rough open land
+    (197, 255, 185),  # green 1 - slow run
+    (139, 255, 116),  # green 2 - walk
+    (61, 255, 23),    # green 3 - fight
+    (0, 160, 255),    # blue - water
+    (145, 210, 255),  # light blue - marsh
+    (128, 128, 128),  # grey - undergrowth
+)
+
+
+def blended_palette(palette, steps=3, background=(255, 255, 255)):
+    """ extends a palette with each colour blended towards the background in even steps - downsampled
+    zoom tiles are averages of the map colours, mostly with the white around them
+    """
+    colours = list(palette)
+    for colour in palette:
+        for step in range(1, steps + 1):
+            weight = step / (steps + 1)
+            blend = tuple(int(round(c * (1 - weight) + b * weight)) for c, b in zip(colour, background))
+            if blend not in colours:
+                colours.append(blend)
+    return tuple(colours)
+
+
+# palette for the zoom tiles - the ISOM colours and their blends with white, which stays well under 256 colours
+ZOOM_PALETTE = blended_palette(ISOM_PALETTE)
+
+# bits kept per channel when indexing the lookup table - 6 bits is 262144 entries, and at most 2 levels of error
+LUT_BITS = 6
+
+
+@functools.lru_cache(maxsize=4)
+def palette_lut(palette):
+    """ precomputes the nearest palette index for every colour, at LUT_BITS per channel.
+    palette is a tuple of (r, g, b) tuples so it can be cached - this is only worked out once per palette per run
+    """
+    levels = 1 << LUT_BITS
+    step = 256 // levels
+    # the centre of each quantised bin, for every r, g, b combination in index order
+    centres = (np.arange(levels, dtype=np.float32) * step + step / 2)
+    grid = np.stack(np.meshgrid(centres, centres, centres, indexing='ij'), axis=-1).reshape(-1, 3)
+
+    best = np.zeros(len(grid), dtype=np.uint8)
+    best_distance = np.full(len(grid), np.inf, dtype=np.float32)
+    for index, colour in enumerate(palette):
+        distance = ((grid - np.array(colour, dtype=np.float32)) ** 2).sum(axis=1)
+        closer = distance < best_distance
+        best[closer] = index
+        best_distance[closer] = distance[closer]
+
+    best.flags.writeable = False  # shared through the cache
+    return best
+
+
+def quantize_rgb(pixels, palette=ISOM_PALETTE):
+    """Maps (rows, cols, 3) uint8 pixels to (rows, cols) palette indices with one gather through the lookup table."""
+    shift = 8 - LUT_BITS
+    r = (pixels[..., 0] >> shift).astype(np.intp)
+    g = (pixels[..., 1] >> shift).astype(np.intp)
+    b = (pixels[..., 2] >> shift).astype(np.intp)
+    return palette_lut(palette)[(r << (2 * LUT_BITS)) | (g << LUT_BITS) | b]
+
+
+def palette_image(pixels, palette=ISOM_PALETTE):
+    """Returns an 8-bit paletted PIL image of (rows, cols, 3) uint8 pixels."""
+    image = Image.fromarray(quantize_rgb(pixels, palette), 'P')
+    image.putpalette([channel for colour in palette for channel in colour])
+    return image
+
+
+def encode_palette_png(pixels, palette=ISOM_PALETTE, compress_level=6):
+    """Encodes (rows, cols, 3) uint8 pixels as an 8-bit paletted PNG."""
+    stream = io.BytesIO()
+    palette_image(pixels, palette).save(stream, format='PNG', compress_level=compress_level)
+    return stream.getvalue()
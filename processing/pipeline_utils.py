@@ -0,0 +1,57 @@
+import asyncio
+
+
+# sentinel passed down the pipeline once the producer has run out of chunks
+STOP = None
+
+
+async def run_stage(name, stage_fn, in_queue, out_queue, workers, on_failure=None):
+    """ runs a pipeline stage - a pool of workers which take chunks from in_queue, await
+    stage_fn(chunk) and pass the chunk on to out_queue (which is bounded, so a full
+    downstream stage pushes back on this one). A chunk whose stage fails is dropped, and
+    handed to on_failure(chunk) if given so whatever it holds can be cleaned up.
+    Once STOP arrives and every worker has finished, STOP is passed to the next stage.
+    """
+
+    async def worker():
+        while True:
+            chunk = await in_queue.get()
+            if chunk is STOP:
+                # put it back so the other workers of this stage also see it
+                await in_queue.put(STOP)
+                return
+
+            try:
+                await stage_fn(chunk)
+            except Exception as e:
+                print(f"Stage {name} failed for chunk {chunk['chunk_id']}: {e}")
+                if on_failure is not None:
+                    try:
+                        on_failure(chunk)
+                    except Exception as cleanup_error:
+                        print(f"Failed to clean up chunk {chunk['chunk_id']}: {cleanup_error}")
+                continue
+
+            if out_queue is not None:
+                await out_queue.put(chunk)
+
+    await asyncio.gather(*[worker() for _ in range(workers)])
+
+    if out_queue is not None:
+        await out_queue.put(STOP)
+
+
+async def run_pipeline(producer, stages, queue_sizes, on_failure=None):
+    """ connects the producer and stages with bounded queues and runs them until the producer stops.
+    producer is a coroutine function taking the first queue, stages is a list of
+    (name, stage_fn, workers) and queue_sizes gives the capacity of the queue in front of each stage.
+    on_failure(chunk) is called for any chunk dropped by a failed stage
+    """
+    queues = [asyncio.Queue(maxsize=size) for size in queue_sizes]
+
+    tasks = [producer(queues[0])]
+    for index, (name, stage_fn, workers) in enumerate(stages):
+        out_queue = queues[index + 1] if index + 1 < len(queues) else None
+        tasks.append(run_stage(name, stage_fn, queues[index], out_queue, workers, on_failure))
+
+    await asyncio.gather(*tasks)
@@ -0,0 +1,131 @@
+import os
+import struct
+import shutil
+
+from processing.download_utils import parse_las_extent
+from processing.lidar_cache import link_or_copy
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# failure classes - empty inputs will never produce output, so they are not retried
+FAILURE_EMPTY = 'empty'
+FAILURE_OOM = 'oom'
+FAILURE_CRASH = 'crash'
+FAILURE_SILENT = 'silent'  # pullauta exited cleanly but the output is missing
+FAILURE_TIMEOUT = 'timeout'  # killed by the watchdog
+
+
+def expected_outputs(laz_name):
+    """Returns the pngs pullauta writes for an input file - we tile from depr, and check both."""
+    return [f"{laz_name}.png", f"{laz_name}_depr.png"]
+
+
+def is_valid_png(file_path):
+    """Cheap corruption check - the file exists, is non empty and starts with the png signature."""
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read(len(PNG_SIGNATURE)) == PNG_SIGNATURE
+    except OSError:
+        return False
+
+
+def find_missing_outputs(laz_dir, output_dir):
+    """ returns the names of the input LAZ files whose outputs are missing or corrupt.
+    corrupt outputs are removed, so pullauta regenerates them
+    """
+    missing = []
+    for laz_name in sorted(f for f in os.listdir(laz_dir) if f.endswith('.laz')):
+        outputs = [os.path.join(output_dir, name) for name in expected_outputs(laz_name)]
+        if all(is_valid_png(path) for path in outputs):
+            continue
+        for path in outputs:
+            if os.path.exists(path) and not is_valid_png(path):
+                print(f"Removing corrupt output {path}")
+                os.remove(path)
+        missing.append(laz_name)
+    return missing
+
+
+def read_local_header(laz_path):
+    """Returns (extent, point count) from a local LAS/LAZ file, or (None, 0) if it has no valid header."""
+    try:
+        with open(laz_path, 'rb') as f:
+            header = f.read(375)
+    except OSError:
+        return None, 0
+
+    extent = parse_las_extent(header)
+    if extent is None:
+        return None, 0
+
+    # LAS 1.4 keeps the real count in a 64 bit field, the legacy 32 bit one may be 0
+    points = struct.unpack_from('<I', header, 107)[0]
+    if header[25] >= 4 and len(header) >= 255:
+        points = max(points, struct.unpack_from('<Q', header, 247)[0])
+    return extent, points
+
+
+def classify_failure(result, laz_path):
+    """Works out why an input produced no output from the pullauta run's CommandResult and the input itself."""
+    _, points = read_local_header(laz_path)
+    if points == 0:
+        return FAILURE_EMPTY
+
+    if result.timeout:
+        return FAILURE_TIMEOUT
+
+    stderr = result.stderr.lower()
+    returncode = result.returncode
+    if returncode in (-9, 137) or 'memory allocation' in stderr or 'out of memory' in stderr:
+        return FAILURE_OOM
+    if returncode != 0:
+        return FAILURE_CRASH
+    return FAILURE_SILENT
+
+
+def stage_retry_inputs(laz_dir, retry_dir, laz_names, margin):
+    """ links the inputs to retry into retry_dir, along with their neighbours within margin metres
+    (so pullauta still has the points past each edge) and the osm zip. Returns the staged names
+    """
+    if os.path.exists(retry_dir):
+        shutil.rmtree(retry_dir)
+    os.makedirs(retry_dir)
+
+    extents = {name: read_local_header(os.path.join(laz_dir, name))[0]
+               for name in os.listdir(laz_dir) if name.endswith('.laz')}
+
+    staged = set(laz_names)
+    for name in laz_names:
+        extent = extents.get(name)
+        if extent is None:
+            continue
+        for other, other_extent in extents.items():
+            if other_extent is None:
+                continue
+            if (other_extent[0] <= extent[2] + margin and other_extent[2] >= extent[0] - margin and
+                    other_extent[1] <= extent[3] + margin and other_extent[3] >= extent[1] - margin):
+                staged.add(other)
+
+    for name in staged:
+        for file_name in [name, name[:-1] + 'x']:
+            if os.path.exists(os.path.join(laz_dir, file_name)):
+                link_or_copy(os.path.join(laz_dir, file_name), os.path.join(retry_dir, file_name))
+    if os.path.exists(os.path.join(laz_dir, 'osm.zip')):
+        link_or_copy(os.path.join(laz_dir, 'osm.zip'), os.path.join(retry_dir, 'osm.zip'))
+
+    return sorted(staged)
+
+
+def collect_retry_outputs(retry_output_dir, output_dir, laz_names):
+    """Moves the outputs of the retried inputs into the chunk's output folder - neighbours' outputs are dropped."""
+    for name in laz_names:
+        for output in expected_outputs(name):
+            retry_path = os.path.join(retry_output_dir, output)
+            if is_valid_png(retry_path):
+                os.replace(retry_path, os.path.join(output_dir, output))
+            # pullauta also writes world files next to the pngs, which rasterio needs to georeference them
+            for world_file in [retry_path[:-4] + '.pgw', retry_path + '.aux.xml']:
+                if os.path.exists(world_file):
+                    os.replace(world_file, os.path.join(output_dir, os.path.basename(world_file)))
+    shutil.rmtree(retry_output_dir)
@@ -0,0 +1,288 @@
+import asyncio
+import os
+import re
+import time
+import signal
+import shutil
+import logging
+import logging.handlers
+from collections import deque, namedtuple
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+# lidar file names as they appear in pullauta/lastile output
+LIDAR_FILE_PATTERN = re.compile(r'([\w\-.]+\.la[sz])\b', re.IGNORECASE)
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 3
+
+WATCHDOG_INTERVAL = 5
+
+# resource usage is sampled from the first moment, and far more often than the watchdog checks, so short runs are still measured
+SAMPLE_INTERVAL = 0.5
+
+# commands running now and started so far - getrusage can't tell the children of concurrent commands apart,
+# so its cpu time is only used for a run which had the worker to itself
+_commands = {'running': 0, 'started': 0}
+
+# the handler of each open log and the number of runs writing to it - runs sharing a log share one handler,
+# so concurrent runs neither duplicate lines nor rotate the file out from under each other
+_log_handlers = {}
+
+# timeout is None, 'wall clock' or 'no progress'. peak RSS and cpu time are 0 where /proc isn't available
+CommandResult = namedtuple('CommandResult', ['returncode', 'stderr', 'timeout', 'seconds', 'peak_rss_mb', 'cpu_seconds'])
+
+
+def open_log(log_path):
+    """ returns a logger writing to a rotating log file, so verbose tools can't fill the disk.
+    every run writing to the same file shares its handler - the caller must close_log once the run is over
+    """
+    path = os.path.abspath(log_path)
+    logger = logging.getLogger(f"subprocess.{path}")
+    if path not in _log_handlers:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        _log_handlers[path] = [handler, 0]
+    _log_handlers[path][1] += 1
+    return logger
+
+
+def close_log(log_path):
+    """Releases a run's hold on a log file, closing its handler once no run is writing to it."""
+    path = os.path.abspath(log_path)
+    _log_handlers[path][1] -= 1
+    if _log_handlers[path][1] == 0:
+        handler = _log_handlers.pop(path)[0]
+        logging.getLogger(f"subprocess.{path}").removeHandler(handler)
+        handler.close()
+
+
+def sample_process_group(pgid):
+    """ reads /proc for every process in the group, returns (total rss bytes, {pid: cpu seconds}).
+    returns (0, {}) on systems without /proc
+    """
+    if not os.path.isdir('/proc'):
+        return 0, {}
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    ticks = os.sysconf('SC_CLK_TCK')
+    rss = 0
+    cpu = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # the command name can hold spaces, so split after its closing bracket
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[2]) != pgid:
+            continue
+        cpu[int(pid)] = (int(fields[11]) + int(fields[12])) / ticks
+        rss += int(fields[21]) * page_size
+    return rss, cpu
+
+
+def children_cpu_seconds():
+    """Returns the user + system cpu time of every child process which has exited and been waited for, or 0 without getrusage."""
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def kill_process_group(process):
+    """Kills a command and everything it started - the shell, the tool and any children."""
+    try:
+        if os.name == 'nt':
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class ProgressTracker:
+    """ tracks per-tile progress of a pullauta/lastile run. A tile is started when the tool first
+    mentions it in its output, and completed when its output file appears in output_dir.
+    """
+
+    def __init__(self, name, tiles, output_dir, output_suffix):
+        self.name = name
+        self.tiles = set(tiles)
+        self.output_dir = output_dir
+        self.output_suffix = output_suffix
+        self.started = {}
+        self.completed = {}
+        self.start_time = time.monotonic()
+
+    def on_line(self, line):
+        """Records the tiles mentioned in a line of tool output as started."""
+        for tile in LIDAR_FILE_PATTERN.findall(line):
+            if tile in self.tiles and tile not in self.started:
+                self.started[tile] = time.monotonic()
+
+    def poll_outputs(self):
+        """Checks the output folder, and returns the tiles completed since the last poll."""
+        if not os.path.isdir(self.output_dir):
+            return []
+        outputs = set(os.listdir(self.output_dir))
+        newly_completed = []
+        for tile in self.tiles:
+            if tile not in self.completed and tile + self.output_suffix in outputs:
+                self.completed[tile] = time.monotonic()
+                newly_completed.append(tile)
+        return newly_completed
+
+    def hung_tiles(self, seconds):
+        """Returns the tiles which started more than seconds ago and still haven't completed."""
+        now = time.monotonic()
+        return [tile for tile, started in self.started.items() if tile not in self.completed and now - started > seconds]
+
+    def summary(self):
+        """Returns a one line progress summary with the tile rate and an ETA."""
+        elapsed_min = (time.monotonic() - self.start_time) / 60
+        done = len(self.completed)
+        rate = done / elapsed_min if elapsed_min > 0 else 0
+        remaining = len(self.tiles) - done
+        eta = f"{remaining / rate:.1f} min" if rate > 0 else "unknown"
+        return f"{self.name}: {done}/{len(self.tiles)} tiles, {rate:.1f} tiles/min, ETA {eta}"
+
+
+async def monitor_progress(tracker, interval, hang_seconds):
+    """Periodically reports a tracker's progress and warns about tiles that look hung, until cancelled."""
+    warned = set()
+    while True:
+        await asyncio.sleep(interval)
+        tracker.poll_outputs()
+        print(tracker.summary())
+        for tile in tracker.hung_tiles(hang_seconds):
+            if tile not in warned:
+                warned.add(tile)
+                print(f"{tracker.name}: {tile} has been running for over {hang_seconds}s - it may be hung")
+
+
+async def run_streaming(command, cwd, log_path=None, tracker=None, tail_lines=50,
+                        wall_timeout=None, progress_timeout=None, cleanup=None):
+    """ runs a command under a watchdog, streaming stdout/stderr line by line into a rotating log
+    (instead of holding it all in memory) and feeding each line to the tracker if given.
+
+    the command runs in its own process group, which is killed if it runs past wall_timeout seconds,
+    or goes progress_timeout seconds without output or a completed tile. cleanup(), if given, is
+    called after a kill to remove whatever the tool left behind. Peak RSS and cpu time of the
+    group are sampled every SAMPLE_INTERVAL while it runs, and the cpu time is topped up from getrusage
+    at the end when no other command ran alongside it. each log line is prefixed with the run number, so
+    runs sharing a log can be told apart. returns a CommandResult
+    """
+    stderr_tail = deque(maxlen=tail_lines)
+
+    # a new session makes the shell a process group leader, so the tool can be killed along with it
+    session = {} if os.name == 'nt' else {'start_new_session': True}
+    start = time.monotonic()
+    _commands['running'] += 1
+    _commands['started'] += 1
+    started_at = _commands['started']
+    alone = _commands['running'] == 1
+    cpu_before = children_cpu_seconds()
+    logger = open_log(log_path) if log_path else None
+    try:
+        process = await asyncio.create_subprocess_shell(
+            command,
+            cwd=cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=1024 * 1024,  # allow for long lines, the default 64KB limit raises on them
+            **session
+        )
+    except Exception:
+        _commands['running'] -= 1
+        if logger:
+            close_log(log_path)
+        raise
+    last_progress = time.monotonic()
+    timeout = None
+    peak_rss = 0
+    cpu = {}
+
+    async def pump(stream, label):
+        nonlocal last_progress
+        while True:
+            raw = await stream.readline()
+            if not raw:
+                return
+            last_progress = time.monotonic()
+            line = raw.decode(errors='replace').rstrip()
+            if logger:
+                logger.info(f"[run {started_at}] [{label}] {line}")
+            if label == 'stderr':
+                stderr_tail.append(line)
+            if tracker:
+                tracker.on_line(line)
+
+    async def watchdog():
+        nonlocal last_progress, timeout, peak_rss
+        last_poll = time.monotonic()
+        while True:
+            if os.name != 'nt':
+                rss, group_cpu = sample_process_group(process.pid)
+                peak_rss = max(peak_rss, rss)
+                # processes that have exited drop out of the sample, so keep the last value seen for each
+                cpu.update(group_cpu)
+            if tracker and time.monotonic() - last_poll >= WATCHDOG_INTERVAL:
+                last_poll = time.monotonic()
+                if tracker.poll_outputs():
+                    last_progress = time.monotonic()
+
+            now = time.monotonic()
+            if wall_timeout and now - start > wall_timeout:
+                timeout = 'wall clock'
+            elif progress_timeout and now - last_progress > progress_timeout:
+                timeout = 'no progress'
+            if timeout:
+                print(f"Killing {command} - {timeout} timeout")
+                kill_process_group(process)
+                return
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    watcher = asyncio.create_task(watchdog())
+    try:
+        if logger:
+            logger.info(f"[run {started_at}] [command] {command}")
+        await asyncio.gather(pump(process.stdout, 'stdout'), pump(process.stderr, 'stderr'))
+        returncode = await process.wait()
+        if logger:
+            logger.info(f"[run {started_at}] [exit] {returncode}" + (f" - killed after {timeout} timeout" if timeout else ""))
+    finally:
+        watcher.cancel()
+        _commands['running'] -= 1
+        if logger:
+            close_log(log_path)
+
+    if timeout and cleanup is not None:
+        cleanup()
+
+    # the samples miss whatever the group used after the last one, the exited children's rusage doesn't
+    cpu_seconds = sum(cpu.values())
+    if alone and _commands['started'] == started_at:
+        cpu_seconds = max(cpu_seconds, children_cpu_seconds() - cpu_before)
+
+    return CommandResult(returncode, '\n'.join(stderr_tail), timeout, time.monotonic() - start,
+                         peak_rss / (1024 * 1024), cpu_seconds)
+
+
+def remove_temp_dirs(work_dir):
+    """Returns a cleanup function which removes the temp folders pullauta leaves in its working directory."""
+    def cleanup():
+        for name in os.listdir(work_dir):
+            if name.startswith('temp') and os.path.isdir(os.path.join(work_dir, name)):
+                shutil.rmtree(os.path.join(work_dir, name), ignore_errors=True)
+    return cleanup
@@ -1,4 +1,6 @@
 import os
+import asyncio
+import concurrent.futures
 import rasterio
 from rasterio.enums import Resampling
 from rasterio.merge import merge
@@ -8,6 +10,11 @@ from rasterio.transform import Affine
 from rasterio.crs import CRS
 import numpy as np
 import math
+import io
+import functools
+from PIL import Image
+
+from processing.palette_utils import encode_palette_png
 
 EXPECTED_CRS = CRS.from_wkt('''
 PROJCRS["NZGD2000 / New Zealand Transverse Mercator 2000",
@@ -47,23 +54,233 @@ PROJCRS["NZGD2000 / New Zealand Transverse Mercator 2000",
 ''')
 
 
-async def crop_and_tile_pngs(process_dir,bounds,tile_size_m):
+def snap_down(val, res):
+    return math.floor(val / res) * res
+
+def snap_up(val, res):
+    return math.ceil(val / res) * res
+
+
+def tile_grid(bounds, target_res):
+    """ works out the output pixel grid for a chunk, exactly as the full mosaic path does:
+    the resampled grid is snapped to target_res around bounds plus a 1m margin, then cropped back to bounds.
+    returns (cropped_transform, width, height)
+    """
+    temp_bounds = (bounds[0]-1, bounds[1]-1, bounds[2]+1, bounds[3]+1)
+    snapped_left = snap_down(temp_bounds[0], target_res)
+    snapped_top = snap_up(temp_bounds[3], target_res)
+    dst_transform = Affine(
+        target_res, 0, snapped_left,
+        0, -target_res, snapped_top
+    )
+
+    crop_window = from_bounds(*bounds, transform=dst_transform)
+    row_off, col_off = int(np.round(crop_window.row_off)), int(np.round(crop_window.col_off))
+    win_height, win_width = int(np.round(crop_window.height)), int(np.round(crop_window.width))
+    return dst_transform * Affine.translation(col_off, row_off), win_width, win_height
+
+
+@functools.lru_cache(maxsize=16)
+def nearest_index_map(offset, dst_res, dst_count, src_res, src_count):
+    """ precomputes nearest neighbour resampling along one axis - for each destination pixel, the index
+    of the source pixel under its centre. offset is the distance from the source grid's origin to the
+    destination grid's origin, measured in the direction the pixels run.
+    every standard 5km chunk has the same offsets, so this is only ever worked out once per run.
+    """
+    centres = offset + (np.arange(dst_count) + 0.5) * dst_res
+    indices = np.clip(np.floor(centres / src_res).astype(np.intp), 0, src_count - 1)
+    indices.flags.writeable = False  # shared through the cache
+    return indices
+
+
+def chunk_index_maps(cropped_transform, width, height, origin, src_res, src_width, src_height):
+    """Returns the (rows, cols) gather indices taking a source grid with its top left at origin onto the cropped grid."""
+    # round the offsets so float noise between chunks doesn't defeat the cache
+    col_offset = round(cropped_transform.c - origin[0], 6)
+    row_offset = round(origin[1] - cropped_transform.f, 6)
+    rows = nearest_index_map(row_offset, -cropped_transform.e, height, src_res[1], src_height)
+    cols = nearest_index_map(col_offset, cropped_transform.a, width, src_res[0], src_width)
+    return rows, cols
+
+
+# PIL image mode for the number of bands in a tile
+PNG_MODES = {1: 'L', 3: 'RGB', 4: 'RGBA'}
+
+
+def tile_name(bounds, i, j):
+    """Names a tile by the coordinates of its bottom left corner, from its pixel position in the chunk."""
+    return f"tile_{int(bounds[0]+((i*200.0)/472.0))}_{int(bounds[3]-(((j+472)*200)/472))}.png"
+
+
+def encode_png(tile_data, compress_level, palette=None):
+    """ encodes a (bands, rows, cols) tile straight to PNG bytes - no GDAL driver and no .aux.xml sidecars.
+    with a palette, the tile's colour bands are mapped onto it and written as an 8-bit paletted PNG
+    """
+    if palette is not None:
+        return encode_palette_png(np.moveaxis(tile_data[:3], 0, -1), palette, compress_level)
+
+    mode = PNG_MODES[tile_data.shape[0]]
+    pixels = tile_data[0] if mode == 'L' else np.moveaxis(tile_data, 0, -1)
+    image = Image.fromarray(np.ascontiguousarray(pixels), mode)
+    stream = io.BytesIO()
+    image.save(stream, format='PNG', compress_level=compress_level)
+    return stream.getvalue()
+
+
+def make_tile_encoder(bounds, compress_level=6, debug_dir=None, palette=None, on_tile=None):
+    """ returns the function the tilers call with each tile, which encodes it in memory and returns
+    (tile name, png bytes). Tiles which are nothing but nodata aren't encoded, and come back as (tile name, None).
+    With debug_dir, the tiles are also written there to be inspected. on_tile, if given, is called with the
+    name and bytes of each encoded tile as soon as it is ready - from the tiling worker threads
+    """
+    def encode(i, j, tile_data):
+        name = tile_name(bounds, i, j)
+        # nodata is the maximum value, so a single reduction tells us the whole tile is white
+        if tile_data.min() == 255:
+            return name, None
+        png = encode_png(tile_data, compress_level, palette)
+        if debug_dir is not None:
+            with open(os.path.join(debug_dir, name), 'wb') as f:
+                f.write(png)
+        if on_tile is not None:
+            on_tile(name, png)
+        return name, png
+    return encode
+
+
+def resample_row(band, band_transform, row, row_transform, num_threads):
+    """Resamples a band of the mosaic onto a row of the target grid with reproject."""
+    for b in range(band.shape[0]):
+        reproject(
+            source=band[b],
+            destination=row[b],
+            src_transform=band_transform,
+            src_crs=EXPECTED_CRS,
+            dst_transform=row_transform,
+            dst_crs=EXPECTED_CRS,
+            resampling=Resampling.nearest,
+            src_nodata=255,
+            dst_nodata=255,
+            num_threads=num_threads
+        )
+
+
+def tile_rows_windowed(src_paths, encode, bounds, row_starts, fast, num_threads):
+    """ builds and encodes the rows of tiles starting at the pixel rows in row_starts, returning the tiles.
+    runs in a worker thread, so it opens its own handles on the sources - datasets can't be shared between threads
+    """
+    nodata_value = 255  # white for 8-bit PNGs
+    target_res = 0.4237288136
+    tile_px = 472
+
+    tiles = []
+    src_files = [rasterio.open(path, crs=EXPECTED_CRS) for path in src_paths]
+    try:
+        dtype = src_files[0].dtypes[0]
+        src_res = src_files[0].res
+
+        # the grid the full mosaic would have been merged onto, so each row lines up with it exactly
+        temp_bounds = (bounds[0]-1, bounds[1]-1, bounds[2]+1, bounds[3]+1)
+        mosaic_width = int(round((temp_bounds[2] - temp_bounds[0]) / src_res[0]))
+        mosaic_height = int(round((temp_bounds[3] - temp_bounds[1]) / src_res[1]))
+
+        cropped_transform, width, height = tile_grid(bounds, target_res)
+        if fast:
+            rows, cols = chunk_index_maps(cropped_transform, width, height, (temp_bounds[0], temp_bounds[3]),
+                                          src_res, mosaic_width, mosaic_height)
+
+        for j in row_starts:
+            h = min(tile_px, height - j)
+            row_top = cropped_transform.f - j * target_res
+            row_bottom = row_top - h * target_res
+
+            # mosaic rows covering this row of tiles, with a pixel spare each side for the resampling
+            m_top = max(0, math.floor((temp_bounds[3] - row_top) / src_res[1]) - 1)
+            m_bottom = min(mosaic_height, math.ceil((temp_bounds[3] - row_bottom) / src_res[1]) + 1)
+            row_bounds = (temp_bounds[0], temp_bounds[3] - m_bottom * src_res[1],
+                          temp_bounds[0] + mosaic_width * src_res[0], temp_bounds[3] - m_top * src_res[1])
+
+            # merge only reads the windows of the sources which overlap the row
+            band, band_transform = merge(src_files, bounds=row_bounds, res=src_res, nodata=nodata_value)
+
+            row = np.full((band.shape[0], tile_px, width), nodata_value, dtype=dtype)
+            row_transform = cropped_transform * Affine.translation(0, j)
+            if fast:
+                # one gather across all bands, with the row indices made relative to this band of the mosaic
+                row[:, :h] = band.take(rows[j:j+h] - m_top, axis=1).take(cols, axis=2)
+            else:
+                resample_row(band, band_transform, row[:, :h], row_transform, num_threads)
+
+            for i in range(0, width, tile_px):
+                w = min(tile_px, width - i)
+                tile_data = np.full((row.shape[0], tile_px, tile_px), nodata_value, dtype=dtype)
+                tile_data[:, :, 0:w] = row[:, :, i:i+w]
+                tiles.append(encode(i, j, tile_data))
+    finally:
+        for src in src_files:
+            src.close()
+
+    return tiles
+
+
+def split_rows(height, tile_px, workers):
+    """Splits the tile rows of a chunk into contiguous bands, one per worker."""
+    row_starts = list(range(0, height, tile_px))
+    band_size = math.ceil(len(row_starts) / workers)
+    return [row_starts[k:k + band_size] for k in range(0, len(row_starts), band_size)]
+
+
+def crop_and_tile_windowed(process_dir, bounds, encode, fast=False, workers=1, num_threads=4):
+    """ windowed version of crop_and_tile_pngs - rather than merging the whole 5km mosaic, each row of
+    tiles is built on its own from windowed reads of the source pngs that overlap it, so memory stays
+    at one row of tiles (about 472px x 11800px) per worker whatever the size of the chunk.
+    the rows are split into bands which are processed in parallel by workers threads
+    """
+    input_dir = os.path.join(process_dir, 'output')
+    src_paths = [os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.lower().endswith("depr.png")]
+    if not src_paths:
+        raise ValueError("No PNGs found in input directory.")
+
+    _, _, height = tile_grid(bounds, 0.4237288136)
+    bands = split_rows(height, 472, workers)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(tile_rows_windowed, src_paths, encode, bounds, row_starts, fast, num_threads) for row_starts in bands]
+        return [tile for future in futures for tile in future.result()]
+
+
+async def crop_and_tile_pngs(process_dir,bounds,tile_size_m,windowed=False,fast=False,workers=1,num_threads=4,
+                             compress_level=6,debug=False,palette=None,on_tile=None):
     """ function which takes a directory of pngs and crops them to the bounds specified
     and then tiles them into smaller pngs of the specified size
+    windowed builds one row of tiles at a time instead of the whole mosaic, to keep memory flat
+    fast replaces the reproject with a single gather through cached nearest neighbour index maps
+    the work is cpu and disk bound, so it runs in worker threads to keep the event loop free -
+    workers is the number of row bands tiled in parallel, num_threads the threads each reproject uses
+    tiles are encoded in memory with zlib level compress_level and returned as (tiles, empty) - a list of
+    (tile name, png bytes), and the names of the tiles skipped for being entirely nodata.
+    tiles are only written to the uploads folder when debug is set
+    palette, a tuple of (r, g, b) colours, writes 8-bit paletted tiles quantised to it rather than RGB
+    on_tile(tile name, png bytes) is called from the worker threads with each tile as it is encoded, so it can be
+    uploaded while the rest are still being tiled
     """
+    debug_dir = os.path.join(process_dir, 'uploads') if debug else None
+    if debug_dir is not None:
+        os.makedirs(debug_dir, exist_ok=True)
+    encode = make_tile_encoder(bounds, compress_level, debug_dir, palette, on_tile)
+    encoded = await asyncio.to_thread(crop_and_tile_sync, process_dir, bounds, encode, windowed, fast, workers, num_threads)
+    tiles = [(name, png) for name, png in encoded if png is not None]
+    empty = [name for name, png in encoded if png is None]
+    return tiles, empty
 
-    def snap_down(val, res):
-        return math.floor(val / res) * res
 
-    def snap_up(val, res):
-        return math.ceil(val / res) * res
+def crop_and_tile_sync(process_dir, bounds, encode, windowed, fast, workers, num_threads):
+    """Blocking body of crop_and_tile_pngs."""
+    if windowed:
+        return crop_and_tile_windowed(process_dir, bounds, encode, fast, workers, num_threads)
 
     nodata_value = 255  # white for 8-bit PNGs
 
     input_dir = os.path.join(process_dir, 'output')
-    output_dir = os.path.join(process_dir, 'uploads')
-
-    crs = EXPECTED_CRS  # Assuming all files have the same CRS
 
     # alternative approach:
 
@@ -93,6 +310,28 @@ async def crop_and_tile_pngs(process_dir,bounds,tile_size_m):
     # we have to resample, or we will get an error seam every 5000m
     target_res = 0.4237288136
 
+    if fast:
+        # gather straight from the mosaic into the cropped grid, so the full resampled array is never built
+        cropped_transform, win_width, win_height = tile_grid(bounds, target_res)
+        rows, cols = chunk_index_maps(cropped_transform, win_width, win_height, (mosaic_transform.c, mosaic_transform.f),
+                                      (mosaic_transform.a, -mosaic_transform.e), mosaic.shape[2], mosaic.shape[1])
+        cropped = mosaic.take(rows, axis=1).take(cols, axis=2)
+        del mosaic
+    else:
+        cropped, cropped_transform = resample_and_crop(mosaic, mosaic_transform, temp_bounds, bounds, target_res, dtype, num_threads)
+
+    # the cropped mosaic is shared read only, so the bands of tile rows can be written in parallel
+    bands = split_rows(cropped.shape[1], 472, workers)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(tile_mosaic, cropped, encode, dtype, row_starts) for row_starts in bands]
+        return [tile for future in futures for tile in future.result()]
+
+
+def resample_and_crop(mosaic, mosaic_transform, temp_bounds, bounds, target_res, dtype, num_threads):
+    """Resamples the mosaic onto the snapped target grid with reproject, and crops it back to bounds."""
+    nodata_value = 255
+    crs = EXPECTED_CRS
+
     # Snap bounds to exact pixel grid
     snapped_left = snap_down(temp_bounds[0], target_res)
     snapped_bottom = snap_down(temp_bounds[1], target_res)
@@ -122,7 +361,7 @@ async def crop_and_tile_pngs(process_dir,bounds,tile_size_m):
             resampling=Resampling.nearest,  
             src_nodata=nodata_value,
             dst_nodata=nodata_value,
-            num_threads=4
+            num_threads=num_threads
         )
     
     # now crop back to the original bounds
@@ -131,19 +370,21 @@ async def crop_and_tile_pngs(process_dir,bounds,tile_size_m):
     win_height, win_width = int(np.round(crop_window.height)), int(np.round(crop_window.width))
     cropped = resampled[:, row_off:row_off+win_height, col_off:col_off+win_width]
     cropped_transform = dst_transform * Affine.translation(col_off, row_off)
-    
-    # write the resampled image to a file for debugging
-    #resampled_path = os.path.join(process_dir, 'resampled.png')
-    #with rasterio.open(resampled_path, "w", driver="PNG", height=cropped.shape[1], width=cropped.shape[2], count=cropped.shape[0], dtype=dtype, crs=crs, transform=cropped_transform) as dst:
-    #    dst.write(cropped)
+    return cropped, cropped_transform
+
+
+def tile_mosaic(cropped, encode, dtype, row_starts):
+    """Splits the rows of the cropped mosaic starting at row_starts into 472px tiles, and returns them encoded."""
+    nodata_value = 255
 
     # === Step 3: Tile into 200m x 200m (472px x 472px) ===
     tile_width_px = 472
     tile_height_px = 472
     bands, height, width = cropped.shape
 
+    tiles = []
     for i in range(0, width, tile_width_px):
-        for j in range(0, height, tile_height_px):
+        for j in row_starts:
 
             w = min(tile_width_px, width - i)
             h = min(tile_height_px, height - j)
@@ -152,22 +393,6 @@ async def crop_and_tile_pngs(process_dir,bounds,tile_size_m):
             tile_data = np.full((bands, tile_height_px, tile_width_px), nodata_value, dtype=dtype)
             tile_data[:, 0:h, 0:w] = cropped[:, j:j+h, i:i+w]
 
-            # Compute the transform for this tile
-            tile_transform = cropped_transform * Affine.translation(i, j)
-
-            # Save the tile
-            tile_meta = {
-                "driver": "PNG",
-                "height": tile_height_px,
-                "width": tile_width_px,
-                "count": bands,
-                "dtype": dtype,
-                "count": 3,               # RGB
-                "crs": crs,
-                "transform": tile_transform,
-                "nodata": None
-            }
-
-            tile_path = os.path.join(output_dir, f"tile_{int(bounds[0]+((i*200.0)/472.0))}_{int(bounds[3]-(((j+472)*200)/472))}.png")
-            with rasterio.open(tile_path, "w", **tile_meta) as dst:
-                dst.write(tile_data)
\ No newline at end of file
+            tiles.append(encode(i, j, tile_data))
+
+    return tiles
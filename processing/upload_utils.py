@@ -0,0 +1,164 @@
+import asyncio
+import time
+import random
+import hashlib
+import functools
+import concurrent.futures
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from collections import namedtuple
+
+from processing.pipeline_utils import STOP
+
+
+TILE_BUCKET = 'nzomap'
+
+MB = 1024 * 1024
+
+# shared backoff applied to every worker once S3 starts returning SlowDown, doubling up to the max
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 20
+
+# uploaded are the keys which changed, skipped those whose content was already published
+UploadResult = namedtuple('UploadResult', ['uploaded', 'skipped', 'failed', 'bytes', 'seconds'])
+
+
+def upload_client(concurrency):
+    """ returns an S3 client with a connection pool for concurrency uploads at once.
+    botocore retries transient errors itself, a SlowDown which survives that is backed off by upload_queue
+    """
+    return boto3.client('s3', config=Config(max_pool_connections=concurrency,
+                                            retries={'max_attempts': 3, 'mode': 'standard'}))
+
+
+def is_slowdown(error):
+    """Checks whether an error is S3 asking us to slow down."""
+    if not isinstance(error, ClientError):
+        return False
+    code = error.response.get('Error', {}).get('Code')
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in ('SlowDown', '503') or status == 503
+
+
+def read_body(body):
+    """Returns the bytes to upload - body is either the bytes themselves or the path of a file."""
+    if isinstance(body, (bytes, bytearray)):
+        return body
+    with open(body, 'rb') as f:
+        return f.read()
+
+
+def published_md5(s3_client, bucket, key):
+    """ returns the md5 of the object at key, or None if there isn't one. tiles are always put in a single
+    request, and the ETag of a single part upload is the md5 of its content
+    """
+    try:
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return head['ETag'].strip('"')
+
+
+def put_tile(s3_client, bucket, key, body, dedupe=False):
+    """ uploads a single tile (blocking), returns the number of bytes sent.
+    with dedupe, a tile identical to the one already published isn't sent and None is returned
+    """
+    data = read_body(body)
+    if dedupe and published_md5(s3_client, bucket, key) == hashlib.md5(data).hexdigest():
+        return None
+    content_type = 'image/png' if key.endswith('.png') else 'binary/octet-stream'
+    s3_client.put_object(Bucket=bucket, Key=key, Body=data, ContentType=content_type)
+    return len(data)
+
+
+async def upload_queue(s3_client, queue, concurrency, bucket=TILE_BUCKET, max_attempts=5, dedupe=False):
+    """ uploads (key, body) items from an asyncio queue as they arrive, where body is bytes or a file path,
+    running concurrency uploads at once, on a thread pool of their own, until STOP is taken from the queue.
+    while S3 is returning SlowDown every worker waits out a shared delay before its next request, which
+    doubles with each SlowDown and halves with each success. with dedupe, each tile's md5 is checked against
+    the published ETag first and unchanged tiles are skipped. returns an UploadResult, and reports throughput
+    """
+    uploaded = []
+    skipped = []
+    failed = []
+    total_bytes = 0
+    delay = 0
+
+    async def upload(key, body):
+        nonlocal total_bytes, delay
+        for attempt in range(1, max_attempts + 1):
+            if delay:
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                size = await loop.run_in_executor(executor, functools.partial(put_tile, s3_client, bucket, key, body, dedupe))
+            except Exception as e:
+                if is_slowdown(e) and attempt < max_attempts:
+                    delay = min(BACKOFF_MAX, max(BACKOFF_BASE, delay * 2))
+                    print(f"SlowDown uploading {key}, backing off {delay:.1f}s")
+                    continue
+                print(f"Failed to upload {key}: {e}")
+                failed.append(key)
+                return
+
+            delay = delay / 2 if delay > BACKOFF_BASE else 0
+            if size is None:
+                skipped.append(key)
+                return
+            uploaded.append(key)
+            total_bytes += size
+            return
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is STOP:
+                # put it back so the other workers also see it
+                await queue.put(STOP)
+                return
+            await upload(*item)
+
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.monotonic() - start
+
+    total = len(uploaded) + len(skipped) + len(failed)
+    print(f"Uploaded {len(uploaded)}/{total} tiles ({len(skipped)} unchanged) - {total_bytes / MB:.1f}MB in {elapsed:.1f}s "
+          f"({len(uploaded) / max(elapsed, 0.001):.1f} tiles/s, {total_bytes / MB / max(elapsed, 0.001):.1f}MB/s)")
+    return UploadResult(uploaded, skipped, failed, total_bytes, elapsed)
+
+
+def delete_tile(s3_client, bucket, key):
+    """Deletes a published tile (blocking), returns whether there was one to delete."""
+    if published_md5(s3_client, bucket, key) is None:
+        return False
+    s3_client.delete_object(Bucket=bucket, Key=key)
+    return True
+
+
+async def delete_tiles(s3_client, keys, concurrency, bucket=TILE_BUCKET):
+    """ deletes whichever of keys are published, running concurrency requests at once on a pool of their own.
+    returns (deleted keys, failed keys)
+    """
+    loop = asyncio.get_running_loop()
+    deleted = []
+    failed = []
+
+    async def delete(key):
+        try:
+            if await loop.run_in_executor(executor, delete_tile, s3_client, bucket, key):
+                deleted.append(key)
+        except Exception as e:
+            print(f"Failed to delete {key}: {e}")
+            failed.append(key)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        await asyncio.gather(*[delete(key) for key in keys])
+
+    if deleted:
+        print(f"Deleted {len(deleted)} published tiles which are now empty")
+    return deleted, failed
@@ -1,12 +1,25 @@
 import asyncio
 import os
 import boto3
+from botocore.config import Config
 import shutil
 import requests
 import json
+import math
+import functools
 import numpy as np
 
+from processing.chunk_manifest import last_good_stage, load_manifest, mark_stage_completed, new_manifest
+from processing.create_zooms_v2 import build_zooms
+from processing.create_zooms_v4 import mark_tiled
+from processing.download_utils import download_lidar_files, prune_lidar_files
+from processing.lidar_cache import LidarCache
+from processing.palette_utils import ISOM_PALETTE
+from processing.pipeline_utils import STOP, run_pipeline
+from processing.pullauta_retry import FAILURE_EMPTY, FAILURE_OOM, FAILURE_SILENT, FAILURE_TIMEOUT, classify_failure, collect_retry_outputs, find_missing_outputs, stage_retry_inputs
+from processing.subprocess_utils import ProgressTracker, monitor_progress, remove_temp_dirs, run_streaming
 from processing.tiling_utils import crop_and_tile_pngs
+from processing.upload_utils import delete_tiles, upload_client, upload_queue
 
 
 ################ SET PARAMS #################
@@ -21,22 +34,124 @@ AREAS_REQUIRING_INDEXING = ['NZ22NZ24_Whanganui']
 # set the number of threads you wish to use here (VCPU or (cores x2)-2 )
 SET_THREADS = 4
 
+# number of chunks claimed ahead of pullauta - being downloaded, indexed or waiting for it - so downloads keep
+# running ahead of pullauta without holding more leases or disk than this. must be at least 1
+PREFETCH_DEPTH = 1
+
+# number of lidar files downloaded at once - each large file is also split into parallel ranged requests
+DOWNLOAD_CONCURRENCY = 8
+
+# lidar files are only downloaded if their points come within this many metres of the chunk,
+# as pullauta reads points from neighbouring files this far past each edge
+PULLAUTA_EDGE_MARGIN = 200
+
+# local cache of downloaded lidar, shared between chunks so boundary files and re-runs aren't downloaded again
+# the budget follows the 15GB of free disk space we recommend for lidar downloads
+LIDAR_CACHE_DIR = 'lidar_cache'
+LIDAR_CACHE_BUDGET_GB = 15
+
+# number of pullauta runs per chunk - the first covers the whole chunk, the rest only the tiles that failed
+PULLAUTA_MAX_ATTEMPTS = 5
+
+# how often (seconds) to report pullauta progress, and how long a tile can run before we warn it may be hung
+PROGRESS_INTERVAL = 60
+TILE_HANG_SECONDS = 900
+
+# (wall clock, no progress) timeouts in seconds for each external tool - a run past either is killed
+TOOL_TIMEOUTS = {
+    'pullauta': (6 * 3600, 1800),
+    'lastile': (3600, 600),
+    'lasindex': (1800, 600),
+}
+
+# every tool run appends its wall clock, cpu time and peak memory here - use it to size SET_THREADS
+RESOURCE_LOG = 'resource_usage.jsonl'
+
+# each tool's output is logged to LOG_DIR/<chunk_id>/<tool>.log - kept outside the chunk's process folder,
+# so the logs of a chunk which failed or was dropped are still there to read
+LOG_DIR = 'logs'
+
+# build z15 tiles one row at a time from windowed reads, rather than from a full in-memory mosaic of the chunk
+WINDOWED_TILING = True
+
+# resample with one gather through precomputed nearest neighbour index maps, rather than a reproject per band
+FAST_RESAMPLE = True
+
+# bands of tile rows tiled in parallel, and threads each reproject may use when FAST_RESAMPLE is off
+TILING_WORKERS = 4
+TILING_THREADS = 4
+
+# z15 tiles are encoded straight to PNG bytes in memory and uploaded from there - zlib level 1 is fastest, 9 smallest
+PNG_COMPRESS_LEVEL = 6
+
+# z15 tiles uploaded at once - the upload client's connection pool is sized to match
+UPLOAD_CONCURRENCY = 32
+
+# compare each tile's md5 with the published ETag and only upload the tiles that changed, so a rerun
+# of an area doesn't rewrite identical tiles or rebuild zooms over them
+DEDUPE_UPLOADS = True
+
+# build zoom 12 to 0 on the worker from the z15 tiles still in memory, rather than invoking the zoom lambda
+# which downloads them all again - the lambda is still used for chunks resumed after their upload
+LOCAL_ZOOMS = True
+ZOOM_WORKERS = 10
+
+# set to True to write z15 tiles as 8-bit PNGs quantised to the fixed ISOM palette, which are several times smaller than RGB
+PALETTE_TILES = False
+
+# set to True to also write the z15 tiles to the chunk's uploads folder, to inspect them
+TILE_DEBUG = False
+
+# set to True to retile the lidar into 200m tiles with lastile before running pullauta
+USE_LASTILE = False
+
+# index (and with USE_LASTILE, tile) each file as soon as it has downloaded, rather than waiting for the whole chunk
+STREAM_INDEXING = True
+INDEX_WORKERS = 2
+
+# size of the regions lastile is run on when streaming - must be a multiple of the 200m tile size
+LASTILE_REGION_SIZE = 1000
+
+# number of workers for each stage of the pipeline - match these to the resource each stage uses
+STAGE_WORKERS = {
+    'download': 1,  # network
+    'index': 1,     # cpu - lasindex/lastile
+    'pullauta': 1,  # cpu - each run uses SET_THREADS threads, raise this on large instances to fill the single threaded tail
+    'tile': 1,      # cpu/disk, with the z15 uploads streaming alongside
+    'upload': 2,    # release the lease
+    'zooms': 1,     # cpu/network - local zoom build (or lambda invoke) and clean up
+}
+
 #############################################
 
+# stages which record a checkpoint in the chunk manifest, in pipeline order
+# tiling isn't one of them - its tiles only live in memory, so a resumed chunk always retiles from the pullauta output
+CHECKPOINT_STAGES = ['download', 'index', 'pullauta', 'upload']
+
 
 
 
 # S3 client configurations
 s3_nz = boto3.client('s3')  # S3 client with full access
 
-s3 = boto3.client('s3',endpoint_url='https://opentopography.s3.sdsc.edu', aws_access_key_id='', aws_secret_access_key='')
+# the connection pool must cover every file downloading at once, each with its own ranged requests
+s3 = boto3.client('s3',endpoint_url='https://opentopography.s3.sdsc.edu', aws_access_key_id='', aws_secret_access_key='',
+                  config=Config(max_pool_connections=DOWNLOAD_CONCURRENCY * 8))
 s3._request_signer.sign = (lambda *args, **kwargs: None)
 
+s3_upload = upload_client(UPLOAD_CONCURRENCY)
+
+lidar_cache = LidarCache(LIDAR_CACHE_DIR, LIDAR_CACHE_BUDGET_GB * 1024 ** 3)
+
 # Command-line tool configurations
 if os.name == 'nt':
     pullauta = 'pullauta'
+    lastile = 'lastile64'
+    lasindex = 'lasindex64'
 else:
     pullauta = './pullauta'
+    lastile = './lastile64'
+    lasindex = './lasindex64'
 
 
 # Utility Functions
@@ -51,58 +166,131 @@ def write_file(file_path, content_lines):
         f.writelines(f"{line}\n" for line in content_lines)
 
 
-async def upload_files(output_folder, chunk_id, xmin, ymin, area_name):
-    files = [f for f in os.listdir(output_folder) if f.endswith('.png')]
+def z15_tile(file_name):
+    """Returns the (x, y) corner coordinates and the z15 (x, y) grid position of a tile from its name."""
+    x, y = map(int, file_name.replace('.png', '').split('_')[1:3])
+    return (x, y), (x // 200, (6553600 - y) // 200)
 
-    async def upload(file):
-        file_name = os.path.basename(file)
-        file_name = file_name.replace('.png', '')
-        x, y = map(int, file_name.split('_')[1:3])
-        if xmin <= x < xmin + 5000 and ymin <= y < ymin + 5000:
-            x_fix, y_fix = x // 200, (6553600 - y) // 200
-            await asyncio.to_thread(
-                s3_nz.upload_file, file, 'nzomap', f'tiles/15/{x_fix}/{y_fix}.png'
-            )
 
-    tasks = [upload(os.path.join(output_folder, file)) for file in files]
-    await asyncio.gather(*tasks)
+def z15_key(file_name, xmin, ymin):
+    """Returns the bucket key for a tile of the chunk at xmin, ymin, or None if the tile lies outside it."""
+    (x, y), (x_fix, y_fix) = z15_tile(file_name)
+    if xmin <= x < xmin + 5000 and ymin <= y < ymin + 5000:
+        return f'tiles/15/{x_fix}/{y_fix}.png'
+    return None
 
-    
+
+def tool_log(process_dir, tool):
+    """Returns the log file of a tool run on the chunk processed in process_dir."""
+    return os.path.join(LOG_DIR, os.path.basename(os.path.normpath(process_dir)), f"{tool}.log")
+
+
+async def release_chunk(chunk_id, area_name):
+    """Releases the lease on a chunk once all its tiles are up."""
     if not area_name == 'LEGACY':
         payload = {
             'uuid': chunk_id,
             'area_name': area_name
         }
-        requests.post('https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/release_area_v2', json=payload)
+        await asyncio.to_thread(requests.post, 'https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/release_area_v2', json=payload)
     
     else:
         payload = {'uuid': chunk_id}
-        requests.post('https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/release_area', json=payload)
+        await asyncio.to_thread(requests.post, 'https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/release_area', json=payload)
 
-    print(f"Uploaded chunk {chunk_id}")
-    return chunk_id
+    print(f"Released chunk {chunk_id}")
 
 
 # Function to Run External Commands
-async def run_command(command, cwd):
-    """Runs an external command asynchronously."""
-    process = await asyncio.create_subprocess_shell(
-        command,
-        cwd=cwd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    stdout, stderr = await process.communicate()
-    if process.returncode == 0:
+async def run_command(tool, command, cwd, log_path=None, tracker=None, cleanup=None, threads=None):
+    """ runs an external command asynchronously under the TOOL_TIMEOUTS watchdog for the tool, streaming its
+    output to log_path and the progress tracker. Resource usage is appended to RESOURCE_LOG.
+    """
+    monitor = None
+    if tracker is not None:
+        monitor = asyncio.create_task(monitor_progress(tracker, PROGRESS_INTERVAL, TILE_HANG_SECONDS))
+
+    wall_timeout, progress_timeout = TOOL_TIMEOUTS[tool]
+    try:
+        result = await run_streaming(command, cwd, log_path, tracker, wall_timeout=wall_timeout,
+                                     progress_timeout=progress_timeout, cleanup=cleanup)
+    finally:
+        if monitor is not None:
+            monitor.cancel()
+
+    if result.returncode == 0:
         print(f"Command completed: {command}")
+    elif result.timeout:
+        print(f"Command killed after {result.timeout} timeout: {command}")
     else:
-        print(f"Command failed: {command}\nError: {stderr.decode()}")
-
-async def run_pullauta(cwd):
-    """Runs the pullauta tool."""
-    await run_command(pullauta, cwd)
-
-def create_pullauta_file(cores, main_dir):
+        print(f"Command failed: {command}\nError: {result.stderr}")
+    if tracker is not None:
+        tracker.poll_outputs()
+        print(tracker.summary())
+
+    print(f"{tool}: {result.seconds:.0f}s, {result.cpu_seconds:.0f}s cpu, peak RSS {result.peak_rss_mb:.0f}MB")
+    record = {'tool': tool, 'threads': threads, 'returncode': result.returncode, 'timeout': result.timeout,
+              'seconds': round(result.seconds, 1), 'cpu_seconds': round(result.cpu_seconds, 1),
+              'peak_rss_mb': round(result.peak_rss_mb, 1)}
+    with open(RESOURCE_LOG, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+
+    return result
+
+def check_result(tool, result):
+    """Raises if a tool run was killed or failed, so its stage fails rather than carrying on without its output."""
+    if result.timeout:
+        raise Exception(f"{tool} killed after {result.timeout} timeout")
+    if result.returncode != 0:
+        raise Exception(f"{tool} failed with exit code {result.returncode}")
+
+def lastile_tracker(name, bounds, tiles_dir):
+    """ tracks a lastile run by the 200m tiles it should write over bounds - lastile names each one
+    tile_{x}_{y}.laz after its lower left corner. tiles without points are never written, so the count can stop short
+    """
+    tiles = [f"tile_{x}_{y}" for x in range(math.floor(bounds[0] / 200) * 200, math.ceil(bounds[2]), 200)
+             for y in range(math.floor(bounds[1] / 200) * 200, math.ceil(bounds[3]), 200)]
+    return ProgressTracker(name, tiles, tiles_dir, '.laz')
+
+async def run_lastile(process_dir,cwd,bounds):
+    """Runs the lastile tool, tracking the tiles it writes over bounds."""
+    tiles_dir = os.path.join(process_dir, 'tiles')
+    cmd = f"{lastile} -i {os.path.join(process_dir, 'downloaded_files', '*.laz')} -tile_size 200 -odir {tiles_dir} -o tile.laz"
+    result = await run_command('lastile', cmd, cwd, tool_log(process_dir, 'lastile'), lastile_tracker('lastile', bounds, tiles_dir))
+    check_result('lastile', result)
+
+async def run_lasindex(process_dir,cwd):
+    """ runs the lasindex tool, tracking the .lax file it writes alongside each file - lasindex prints
+    nothing as it goes, so they are the only sign of progress
+    """
+    laz_dir = os.path.join(process_dir, 'downloaded_files')
+    cmd = f"{lasindex} -i {os.path.join(laz_dir, '*.laz')}"
+    files = [name[:-len('.laz')] for name in os.listdir(laz_dir) if name.endswith('.laz')]
+    result = await run_command('lasindex', cmd, cwd, tool_log(process_dir, 'lasindex'), ProgressTracker('lasindex', files, laz_dir, '.lax'))
+    check_result('lasindex', result)
+
+async def run_lastile_region(process_dir,cwd,region,files):
+    """Runs the lastile tool on the files covering one region, keeping only the points inside it."""
+    tiles_dir = os.path.join(process_dir, 'tiles')
+    inputs = ' '.join(os.path.join(process_dir, 'downloaded_files', f) for f in files)
+    cmd = f"{lastile} -i {inputs} -keep_xy {region[0]} {region[1]} {region[2]} {region[3]} -tile_size 200 -odir {tiles_dir} -o tile.laz"
+    tracker = lastile_tracker(f"lastile {region[0]}_{region[1]}", region, tiles_dir)
+    result = await run_command('lastile', cmd, cwd, tool_log(process_dir, 'lastile'), tracker)
+    check_result('lastile', result)
+
+async def run_lasindex_file(process_dir,file_path,cwd):
+    """Runs the lasindex tool on a single file."""
+    result = await run_command('lasindex', f"{lasindex} -i {file_path}", cwd, tool_log(process_dir, 'lasindex'))
+    check_result('lasindex', result)
+
+async def run_pullauta(work_dir, threads, log_path=None, tracker=None):
+    """Runs the pullauta tool in a chunk's working directory, clearing its temp folders if it has to be killed."""
+    # a local binary must be given by absolute path, as it is run from the working directory
+    local_binary = shutil.which(pullauta, path=os.getcwd())
+    command = os.path.abspath(local_binary) if local_binary else pullauta
+    return await run_command('pullauta', command, work_dir, log_path, tracker, remove_temp_dirs(work_dir), threads)
+
+def create_pullauta_file(cores, main_dir, laz_dir, work_dir, output_dir=None):
     """Generates the pullauta.ini configuration file."""
     content = [
         "vegemode=0",
@@ -160,9 +348,9 @@ def create_pullauta_file(cores, main_dir):
         "waterclass=9",
         "detectbuildings=0",
         "batch=1",
-        f"processes={SET_THREADS}",
-        "batchoutfolder="+os.path.join(main_dir, 'output').replace("\\", "/"),
-        "lazfolder="+os.path.join(main_dir, 'downloaded_files').replace("\\", "/"),
+        f"processes={cores}",
+        "batchoutfolder="+os.path.abspath(output_dir or os.path.join(main_dir, 'output')).replace("\\", "/"),
+        "lazfolder="+os.path.abspath(laz_dir).replace("\\", "/"),
         "vectorconf=osm.txt",
         "mtkskiplayers=",
         "buildingcolor=0,0,0",
@@ -172,9 +360,9 @@ def create_pullauta_file(cores, main_dir):
         "scalefactor=1",
         "zoffset=0",
     ]
-    write_file("pullauta.ini", content)
+    write_file(os.path.join(work_dir, "pullauta.ini"), content)
 
-def create_osm_txt_file():
+def create_osm_txt_file(work_dir):
     """Generates the osm.txt configuration file."""
     content = [
         'power line|524|barrier!=',
@@ -259,196 +447,518 @@ def create_osm_txt_file():
         'road-path|504T|highway=share_busway&bridge=yes',
         'road-path|504T|highway=shared_lane&bridge=yes'
     ]
-    write_file( "osm.txt", content)
-
+    write_file(os.path.join(work_dir, "osm.txt"), content)
 
-async def process_chunk(chunk_id, xmin, ymin, file_list,area_name, download_semaphore, pullauta_semaphore):
-    """Processes a chunk of data."""
-    process_dir = os.path.join("process", str(chunk_id))
 
-    # ensure the process directory is empty
-    try:
-        shutil.rmtree(process_dir)
-    except:
-        pass
+async def stage_download(chunk):
+    """Download stage - prepares the chunk directory and downloads the lidar files."""
+    chunk_id = chunk['chunk_id']
+    process_dir = chunk['process_dir']
 
-    cwd = os.getcwd()
-    ensure_dir(process_dir)
-    ensure_dir(os.path.join(process_dir, "uploads"))
-    ensure_dir(os.path.join(process_dir, "output"))
-    
-    # Download files from S3
+    # Download files from S3 - clearing anything left by an interrupted download
     print(f"Processing chunk {chunk_id}")
     downloaded_files_dir = os.path.join(process_dir, "downloaded_files")
+    for sub_dir in ["downloaded_files", "tiles"]:
+        try:
+            shutil.rmtree(os.path.join(process_dir, sub_dir))
+        except:
+            pass
     ensure_dir(downloaded_files_dir)
-    
-    # Ensure only one download runs at a time
-    async with download_semaphore:
-        print(f"Downloading data for chunk {chunk_id}")
-        for file in file_list.split(','):
-            file_name = os.path.basename(file)
-            if(file_name.endswith('x') and area_name in AREAS_REQUIRING_INDEXING):
-                print(f"Skipping {file_name} as LAX files need to be regenerated for this area")
-                continue
 
-            path_without_bucket = file.replace('https://opentopography.s3.sdsc.edu/pc-bulk/', '')
-            try:
-                s3.download_file('pc-bulk', path_without_bucket, os.path.join(downloaded_files_dir, file_name))
-            except Exception as e:
-                print(f"Failed to download {file}: {e}")
-                pass
+    print(f"Downloading data for chunk {chunk_id}")
+    urls = []
+    for file in chunk['file_list'].split(','):
+        file_name = os.path.basename(file)
+        if(file_name.endswith('x') and chunk['area_name'] in AREAS_REQUIRING_INDEXING):
+            print(f"Skipping {file_name} as LAX files need to be regenerated for this area")
+            continue
+        urls.append(file)
 
-        print(f"Finished downloading data for chunk {chunk_id}")
+    # check the real extent of each file, so we only download what pullauta will actually use
+    xmin, ymin = chunk['xmin'], chunk['ymin']
+    urls, chunk['extents'] = await prune_lidar_files(s3, urls, (xmin, ymin, xmin + 5000, ymin + 5000), PULLAUTA_EDGE_MARGIN, DOWNLOAD_CONCURRENCY)
 
+    if STREAM_INDEXING:
+        await download_and_index(chunk, urls, downloaded_files_dir)
+    else:
+        await download_lidar_files(s3, urls, downloaded_files_dir, DOWNLOAD_CONCURRENCY, cache=lidar_cache)
 
-    async with pullauta_semaphore:
-        # Run pullauta tool and then tile
-        # Generate new configuration files
-        try:
-            os.remove("pullauta.ini")
-            os.remove("osm.txt")
-            os.remove("osm.zip")
-        except:
-            pass
+    # download the osm zip - must go in the input 'downloaded_files' folder
+    try:
+        await asyncio.to_thread(s3_nz.download_file, 'nzomap', f"osm/5000/{chunk['xmin']}_{chunk['ymin']}.zip", os.path.join(downloaded_files_dir, 'osm.zip'))
+    except:
+        pass
 
-        # remove temp folders if they exist - to prevent weird bugs where data is not deleted
-        try:
-            for thread in range(SET_THREADS):
-                if os.path.exists(f"temp{thread+1}"):
-                    shutil.rmtree(f"temp{thread+1}")
-        except:
-            pass
+    print(f"Finished downloading data for chunk {chunk_id}")
+
+def lastile_regions(extents, file_names, bounds):
+    """ splits the area covered by the chunk's lidar into LASTILE_REGION_SIZE squares, and works out
+    which files each one needs. Returns {(xmin, ymin, xmax, ymax): set of file names}.
+    if no file could be probed there is nothing to split on, so bounds is one region needing every file
+    """
+    known = {os.path.basename(url): extent for url, extent in extents.items() if extent is not None}
+    # a file we couldn't probe might cover any region, so every region has to wait for it
+    unknown = {name for name in file_names if name not in known}
+    if not known:
+        return {tuple(bounds): set(file_names)} if file_names else {}
+
+    size = LASTILE_REGION_SIZE
+    left = math.floor(min(extent[0] for extent in known.values()) / size) * size
+    bottom = math.floor(min(extent[1] for extent in known.values()) / size) * size
+    right = math.ceil(max(extent[2] for extent in known.values()) / size) * size
+    top = math.ceil(max(extent[3] for extent in known.values()) / size) * size
+
+    regions = {}
+    for x in range(left, right, size):
+        for y in range(bottom, top, size):
+            files = {name for name, extent in known.items()
+                     if extent[0] < x + size and extent[2] >= x and extent[1] < y + size and extent[3] >= y}
+            if files:
+                regions[(x, y, x + size, y + size)] = files | unknown
+    return regions
+
+async def download_and_index(chunk, urls, downloaded_files_dir):
+    """ streaming download - each LAZ file is handed to a pool of lasindex workers as soon as it lands,
+    and when USE_LASTILE is set, lastile runs on each region as soon as every file covering it is ready
+    """
+    process_dir = chunk['process_dir']
+    cwd = os.getcwd()
+    needs_index = chunk['area_name'] in AREAS_REQUIRING_INDEXING
+
+    laz_names = [os.path.basename(url) for url in urls if url.lower().endswith('.laz')]
+    margin = PULLAUTA_EDGE_MARGIN
+    chunk_bounds = (chunk['xmin'] - margin, chunk['ymin'] - margin, chunk['xmin'] + 5000 + margin, chunk['ymin'] + 5000 + margin)
+    pending_regions = lastile_regions(chunk['extents'], laz_names, chunk_bounds) if USE_LASTILE else {}
+    if USE_LASTILE:
+        ensure_dir(os.path.join(process_dir, "tiles"))
+
+    index_queue = asyncio.Queue()
+    index_semaphore = asyncio.Semaphore(INDEX_WORKERS)  # lasindex and lastile share the cpu budget
+    ready = set()
+    region_tasks = []
+
+    async def tile_region(region, files):
+        async with index_semaphore:
+            await run_lastile_region(process_dir, cwd, region, sorted(files))
+
+    def start_ready_regions(final=False):
+        for region, files in list(pending_regions.items()):
+            if final or files <= ready:
+                del pending_regions[region]
+                # at the end, files that failed to download are left out rather than waited for
+                if files & ready:
+                    region_tasks.append(asyncio.create_task(tile_region(region, files & ready)))
+
+    async def index_worker():
+        while True:
+            file_name = await index_queue.get()
+            if file_name is None:
+                return
+            if needs_index:
+                async with index_semaphore:
+                    await run_lasindex_file(process_dir, os.path.join(downloaded_files_dir, file_name), cwd)
+            ready.add(file_name)
+            start_ready_regions()
+
+    async def on_downloaded(file_name):
+        if file_name.lower().endswith('.laz'):
+            await index_queue.put(file_name)
+
+    workers = [asyncio.create_task(index_worker()) for _ in range(INDEX_WORKERS)]
+    await download_lidar_files(s3, urls, downloaded_files_dir, DOWNLOAD_CONCURRENCY, cache=lidar_cache, on_downloaded=on_downloaded)
+    for _ in workers:
+        await index_queue.put(None)
+    # every run is let finish before a failure is raised, so none is left running on a chunk being dropped
+    failures = [e for e in await asyncio.gather(*workers, return_exceptions=True) if isinstance(e, Exception)]
+
+    if not failures:
+        start_ready_regions(final=True)
+    failures += [e for e in await asyncio.gather(*region_tasks, return_exceptions=True) if isinstance(e, Exception)]
+    if failures:
+        raise failures[0]
+    chunk['streamed'] = True
+
+async def stage_index(chunk):
+    """Index stage - regenerates lax files where required, and retiles the lidar if USE_LASTILE is set."""
+    process_dir = chunk['process_dir']
+    cwd = os.getcwd()
+    chunk['laz_dir'] = os.path.join(process_dir, "downloaded_files")
+
+    # a streamed download has already indexed and tiled the files as they arrived
+    if not chunk.get('streamed'):
+        if chunk['area_name'] in AREAS_REQUIRING_INDEXING:
+            await run_lasindex(process_dir, cwd)
+
+        if USE_LASTILE:
+            ensure_dir(os.path.join(process_dir, "tiles"))
+            margin = PULLAUTA_EDGE_MARGIN
+            bounds = (chunk['xmin'] - margin, chunk['ymin'] - margin, chunk['xmin'] + 5000 + margin, chunk['ymin'] + 5000 + margin)
+            await run_lastile(process_dir, cwd, bounds)
+
+    if USE_LASTILE:
+        # pullauta expects the osm zip alongside the lidar it is processing
+        if os.path.exists(os.path.join(chunk['laz_dir'], 'osm.zip')):
+            shutil.copyfile(os.path.join(chunk['laz_dir'], 'osm.zip'), os.path.join(process_dir, "tiles", 'osm.zip'))
+        chunk['laz_dir'] = os.path.join(process_dir, "tiles")
+
+async def stage_pullauta(chunk):
+    """Pullauta stage - renders the chunk's lidar into georeferenced pngs."""
+    chunk_id = chunk['chunk_id']
+    process_dir = chunk['process_dir']
+
+    # pullauta reads its config from, and writes its temp folders to, its working directory -
+    # so each chunk gets its own, and pullauta runs can happen side by side
+    work_dir = os.path.join(process_dir, "pullauta_work")
+    try:
+        shutil.rmtree(work_dir)
+    except:
+        pass
+    ensure_dir(work_dir)
+
+    create_pullauta_file(SET_THREADS, process_dir, chunk['laz_dir'], work_dir)
+    create_osm_txt_file(work_dir)
+
+    output_dir = os.path.join(process_dir, "output")
+    log_path = tool_log(process_dir, 'pullauta')
+    inputs = [f for f in os.listdir(chunk['laz_dir']) if f.endswith('.laz')]
+
+    print(f"Running pullauta for chunk {chunk_id}")
+    tracker = ProgressTracker(f"pullauta {chunk_id}", inputs, output_dir, '.png')
+    result = await run_pullauta(work_dir, SET_THREADS, log_path, tracker)
+
+    # retry only the inputs whose outputs are missing or corrupt, staged on their own with their neighbours
+    retry_dir = os.path.join(process_dir, "retry_input")
+    retry_output_dir = os.path.join(process_dir, "retry_output")
+    failures = {}
+    given_up = set()
+    threads = SET_THREADS
+
+    def classify_missing():
+        """Records why each input still without output failed in the last run, and returns those still worth retrying."""
+        missing = [name for name in find_missing_outputs(chunk['laz_dir'], output_dir) if name not in given_up]
+        for name in missing:
+            failure = classify_failure(result, os.path.join(chunk['laz_dir'], name))
+            failures.setdefault(name, []).append(failure)
+            # empty inputs will never render, and a clean exit with no output (or a hang) twice running won't change
+            if (failure == FAILURE_EMPTY or failures[name][-2:] == [FAILURE_SILENT, FAILURE_SILENT]
+                    or failures[name][-2:] == [FAILURE_TIMEOUT, FAILURE_TIMEOUT]):
+                print(f"Giving up on {name} for chunk {chunk_id} - {failure}")
+                given_up.add(name)
+        return [name for name in missing if name not in given_up]
+
+    for attempt in range(2, PULLAUTA_MAX_ATTEMPTS + 1):
+        missing = classify_missing()
+        if not missing:
+            break
+
+        # running out of memory is the one failure fewer threads can fix
+        if any(failures[name][-1] == FAILURE_OOM for name in missing):
+            threads = max(1, threads // 2)
+
+        staged = stage_retry_inputs(chunk['laz_dir'], retry_dir, missing, PULLAUTA_EDGE_MARGIN)
+        ensure_dir(retry_output_dir)
+        create_pullauta_file(threads, process_dir, retry_dir, work_dir, retry_output_dir)
+        # a crashed run leaves its temp folders behind, which would corrupt the retry
+        remove_temp_dirs(work_dir)()
+        print(f"Retrying pullauta for {len(missing)} tiles ({len(staged)} staged) in chunk {chunk_id} - attempt {attempt}, {threads} threads")
+        tracker = ProgressTracker(f"pullauta {chunk_id} retry", missing, retry_output_dir, '.png')
+        result = await run_pullauta(work_dir, threads, log_path, tracker)
+        collect_retry_outputs(retry_output_dir, output_dir, missing)
+    else:
+        # out of attempts - record how the last one went for the failure summary
+        classify_missing()
+
+    if os.path.exists(retry_dir):
+        shutil.rmtree(retry_dir)
+    if failures:
+        summary = ', '.join(f"{name}: {' > '.join(history)}" for name, history in failures.items())
+        print(f"Pullauta failures for chunk {chunk_id} - {summary}")
+
+async def stage_tile(chunk):
+    """ tiling stage - splits the pullauta output into 200m z15 tiles, held in memory, and uploads each tile
+    as soon as it is encoded so the cpu bound tiling and network bound uploads overlap
+    """
+    if chunk['resume_after'] >= CHECKPOINT_STAGES.index('upload'):
+        print(f"Skipping tile for chunk {chunk['chunk_id']} - already uploaded")
+        return
+    xmin, ymin = chunk['xmin'], chunk['ymin']
+
+    # bounded, so tiling waits for the uploads rather than piling up tiles if the network falls behind
+    tile_queue = asyncio.Queue(maxsize=UPLOAD_CONCURRENCY * 2)
+    loop = asyncio.get_running_loop()
+    local_tiles = {}
+
+    def on_tile(file_name, png):
+        # called from the tiling threads, so hand the tile over to the event loop and wait for room in the queue
+        key = z15_key(file_name, xmin, ymin)
+        if key is not None:
+            local_tiles[z15_tile(file_name)[1]] = png
+            asyncio.run_coroutine_threadsafe(tile_queue.put((key, png)), loop).result()
+
+    uploader = asyncio.create_task(upload_queue(s3_upload, tile_queue, UPLOAD_CONCURRENCY, dedupe=DEDUPE_UPLOADS))
+    try:
+        tiles, empty = await crop_and_tile_pngs(chunk['process_dir'], (xmin, ymin, xmin + 5000, ymin + 5000), 200,
+                                                windowed=WINDOWED_TILING, fast=FAST_RESAMPLE, workers=TILING_WORKERS,
+                                                num_threads=TILING_THREADS, compress_level=PNG_COMPRESS_LEVEL, debug=TILE_DEBUG,
+                                                palette=ISOM_PALETTE if PALETTE_TILES else None, on_tile=on_tile)
+    finally:
+        await tile_queue.put(STOP)
+        # underscored chunk keys are never written to the manifest
+        chunk['_upload_result'] = await uploader
+    # kept for building the zooms locally
+    chunk['_tiles'] = local_tiles
+
+    # the z15 positions of tiles left out for being entirely nodata - recorded in the manifest with the
+    # upload checkpoint, and passed to the zoom builder so it knows they are absent on purpose
+    chunk['empty_tiles'] = sorted(z15_tile(name)[1] for name in empty)
+    if empty:
+        print(f"Skipping {len(empty)}/{len(empty) + len(tiles)} empty tiles for chunk {chunk['chunk_id']}")
+
+    # a tile which had content in an earlier run of the area but is empty now has to go, or z15 would keep showing it
+    empty_keys = [key for key in (z15_key(name, xmin, ymin) for name in empty) if key is not None]
+    chunk['_deleted'] = await delete_tiles(s3_upload, empty_keys, UPLOAD_CONCURRENCY)
+
+async def stage_upload(chunk):
+    """ upload stage - checks every z15 tile made it up and releases the chunk. the chunk is only
+    released once every tile is up, a failed tile fails the stage
+    """
+    result = chunk.pop('_upload_result')
+    deleted, failed_deletes = chunk.pop('_deleted')
+    if result.failed or failed_deletes:
+        raise Exception(f"{len(result.failed)} tiles failed to upload, {len(failed_deletes)} to delete")
+    await release_chunk(chunk['chunk_id'], chunk['area_name'])
+
+    # kept in the manifest with the upload checkpoint, so the zoom rebuild can be limited to their parents -
+    # deleted tiles count as changed, so their parents are rebuilt without them
+    chunk['changed_tiles'] = result.uploaded + deleted
+    print(f"Finished processing and uploading chunk {chunk['chunk_id']} - {len(chunk['changed_tiles'])} tiles changed")
+
+async def mark_chunk_tiled(chunk):
+    """Sets the tiled flag of a chunk in ProcessingAreasV2, as the zoom lambda does once it has built the zooms."""
+    # legacy chunks aren't in ProcessingAreasV2, so there is no flag to set
+    if chunk['area_name'] != 'LEGACY':
+        attributes = {'lidar_dataset': {'S': chunk['area_name']}, 'uuid': {'S': chunk['chunk_id']}}
+        await asyncio.to_thread(mark_tiled, attributes)
+
+async def build_zooms_locally(chunk):
+    """ builds a chunk's zooms from its in-memory z15 tiles and marks it tiled, as the lambda would.
+    returns False if the build fails, so the caller can fall back to the lambda - once the zooms are built,
+    failing to mark the chunk is only reported, as rebuilding them in the lambda wouldn't help
+    """
+    try:
+        await asyncio.to_thread(build_zooms, chunk.pop('_tiles'), chunk.get('empty_tiles', []), ZOOM_WORKERS,
+                                chunk.get('changed_tiles'))
+    except Exception as e:
+        print(f"Failed to build zooms for chunk {chunk['chunk_id']}, falling back to the lambda: {e}")
+        return False
+    try:
+        await mark_chunk_tiled(chunk)
+    except Exception as e:
+        print(f"Failed to mark chunk {chunk['chunk_id']} as tiled: {e}")
+    return True
 
-        # download the osm zip - must go in the input 'downloaded_files' folder
+async def stage_zooms(chunk):
+    """Zoom stage - builds (or requests tiling of) the lower zoom levels and cleans up the chunk."""
+    chunk_id = chunk['chunk_id']
+
+    # build the zooms for the new chunk, unless none of its tiles changed - locally from the z15 tiles still
+    # in memory if we can, otherwise (or if that fails) by requesting tiling from the lambda
+    if not chunk.get('changed_tiles', True):
+        print(f"No tiles changed for chunk {chunk_id}, its zooms are already up to date")
         try:
-            s3_nz.download_file('nzomap', f'osm/5000/{xmin}_{ymin}.zip', os.path.join(os.path.join(process_dir, "downloaded_files"), 'osm.zip'))
-        
-        except:
+            await mark_chunk_tiled(chunk)
+        except Exception as e:
+            print(f"Failed to mark chunk {chunk_id} as tiled: {e}")
+    elif not (LOCAL_ZOOMS and '_tiles' in chunk and await build_zooms_locally(chunk)):
+        try:
+            payload = {
+                "xmin": chunk['xmin'],
+                "ymin": chunk['ymin'],
+                "area_name": chunk['area_name'],
+                "uuid": chunk_id,
+                "empty_tiles": chunk.get('empty_tiles', []),
+                "changed_tiles": chunk.get('changed_tiles')
+            }
+            await asyncio.to_thread(
+                boto3.client('lambda', region_name='us-east-2').invoke,
+                FunctionName='arn:aws:lambda:us-east-2:664418968878:function:nzomapCreateZooms',
+                InvocationType='Event',  # async fire-and-forget
+                Payload=json.dumps(payload).encode('utf-8')
+            )
+        except Exception as e:
+            print(f"Failed to invoke lambda function for chunk {chunk_id}: {e}")
             pass
 
-        create_pullauta_file(SET_THREADS, process_dir)
-        create_osm_txt_file()
-
-        # run pullauta until all files are processed, or 20 retries
-        for i in range(20):
-            print(f"Running pullauta for chunk {chunk_id} - attempt {i+1}")
-            await run_pullauta(cwd)
-            output_pngs = [f for f in os.listdir(os.path.join(process_dir, "output")) if f.endswith('.laz.png')]
-            input_tiles = [f for f in os.listdir(os.path.join(process_dir, "downloaded_files")) if f.endswith('.laz')]
-            if len(output_pngs) == len(input_tiles):
-                break
-    
-    # now we must split the output pngs into tiles
+    # Clean up
+    shutil.rmtree(chunk['process_dir'])
+    print(f"Cleaned up temporary files for chunk {chunk_id}")
 
-    await crop_and_tile_pngs(process_dir, (xmin, ymin, xmin + 5000, ymin + 5000), 200)
+def snap_to_chunk(value):
+    """Snaps a chunk coordinate returned by the API onto the 5000m chunk grid."""
+    if value // 5000 != value / 5000:
+        diff = value % 5000
+        if (value + diff) // 5000 != (value + diff) / 5000:
+            diff = -diff
+        value = int(np.round(value + diff))
+    return value
+
+def claim_chunk():
+    """Claims the next chunk to process from the API, returns None when no areas are left."""
+    if SPECIFIED_AREA is not None:
+        payload = {
+            "area_name": SPECIFIED_AREA
+        }
+        # eg "area_name": "NZ20_Hawkes"
 
-    # Upload results to S3
-    output_folder = os.path.join(process_dir, "uploads")
-    uploaded_chunk = await upload_files(output_folder, chunk_id, xmin, ymin, area_name)
-    print(f"Finished processing and uploading chunk {uploaded_chunk}")
+        r = requests.post("https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/new_area_specific",json=payload)
 
-    # request tiling for the new chunk
+    else:
+        r = requests.post("https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/new_area_specific")
+
+    if r.status_code != 200:
+        return None
+
+    returned_json = json.loads(r.json()["body"])
+    return {
+        "chunk_id": returned_json["uuid"],
+        "xmin": snap_to_chunk(int(returned_json["xmin"])),
+        "ymin": snap_to_chunk(int(returned_json["ymin"])),
+        "file_list": returned_json["files"],
+        'overwrite': returned_json['overwrite'],
+        'area_name': returned_json['area_name'] if 'area_name' in returned_json else 'LEGACY'
+    }
+
+def start_chunk(chunk):
+    """Creates a clean process directory and manifest for a newly claimed chunk."""
+    process_dir = os.path.join("process", str(chunk['chunk_id']))
+    chunk['process_dir'] = process_dir
+
+    # ensure the process directory is empty
     try:
-        payload = {
-            "xmin": xmin,
-            "ymin": ymin,
-            "area_name": area_name,
-            "uuid": chunk_id
-        }
-        boto3.client('lambda', region_name='us-east-2').invoke(
-            FunctionName='arn:aws:lambda:us-east-2:664418968878:function:nzomapCreateZooms',
-            InvocationType='Event',  # async fire-and-forget
-            Payload=json.dumps(payload).encode('utf-8')
-        )
-    except Exception as e:
-        print(f"Failed to invoke lambda function for chunk {chunk_id}: {e}")
+        shutil.rmtree(process_dir)
+    except:
         pass
 
-    # Clean up
-    shutil.rmtree(process_dir)
-    print(f"Cleaned up temporary files for chunk {chunk_id}")
+    ensure_dir(process_dir)
+    ensure_dir(os.path.join(process_dir, "output"))
 
-async def main(chunks):
-    """Main function to process all chunks."""
+    new_manifest(process_dir, chunk)
+    chunk['resume_after'] = -1
+    return chunk
+
+def resume_chunks():
+    """ finds chunks left in the process directory by a previous run, re-attaches to their leases
+    and works out which stage each can continue from. Anything that can't be resumed is removed.
+    """
+    chunks = []
+    if not os.path.exists("process"):
+        return chunks
+
+    for folder in os.listdir("process"):
+        process_dir = os.path.join("process", folder)
+        if not os.path.isdir(process_dir):
+            continue
+
+        manifest = load_manifest(process_dir)
+        if manifest is None or 'chunk' not in manifest:
+            print(f"No manifest for {process_dir}, removing it")
+            shutil.rmtree(process_dir)
+            continue
+
+        chunk = manifest['chunk']
+        chunk['process_dir'] = process_dir
+        chunk['resume_after'] = last_good_stage(process_dir, manifest, CHECKPOINT_STAGES)
+
+        # once uploaded the lease has been released, so there is nothing to re-attach to
+        if chunk['resume_after'] < CHECKPOINT_STAGES.index('upload'):
+            payload = {'uuid': chunk['chunk_id']}
+            r = requests.get('https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/check_area',json=payload)
+            if r.status_code != 200:
+                print(f"Lost the lease for chunk {chunk['chunk_id']}, removing it")
+                shutil.rmtree(process_dir)
+                continue
 
-    # Semaphore instances to control concurrency
-    download_semaphore = asyncio.Semaphore(1)  # Only one download at a time
-    pullauta_semaphore = asyncio.Semaphore(1)  # Only one pullauta execution at a time
+        resumed_from = CHECKPOINT_STAGES[chunk['resume_after']] if chunk['resume_after'] >= 0 else 'the start'
+        print(f"Resuming chunk {chunk['chunk_id']} after {resumed_from}")
+        chunks.append(chunk)
+
+    return chunks
+
+def checkpointed(stage, stage_fn, sub_dirs):
+    """Wraps a stage so it is skipped when resuming past it, and checkpointed when it completes."""
+    async def run(chunk):
+        if CHECKPOINT_STAGES.index(stage) <= chunk['resume_after']:
+            print(f"Skipping {stage} for chunk {chunk['chunk_id']} - already completed")
+            return
+        await stage_fn(chunk)
+        await asyncio.to_thread(mark_stage_completed, chunk['process_dir'], chunk, stage, sub_dirs)
+    return run
+
+def release_slot(chunk, slots):
+    """Gives back the prefetch slot a chunk holds, if it still holds one."""
+    if chunk.pop('_holds_slot', False):
+        slots.release()
+
+def entering_pullauta(stage_fn, slots):
+    """Wraps the pullauta stage so each chunk gives back its prefetch slot as it reaches pullauta."""
+    async def run(chunk):
+        release_slot(chunk, slots)
+        await stage_fn(chunk)
+    return run
+
+def dropping_chunk(slots):
+    """ returns the clean up for a chunk whose stage failed - its process directory can hold GBs of lidar and
+    pullauta output, which would otherwise sit on disk for the life of the worker, and it may still hold a
+    prefetch slot. there is no way to hand a lease back without marking the chunk done, so the lease is left
+    to expire and the chunk is claimed again later
+    """
+    def drop(chunk):
+        release_slot(chunk, slots)
+        shutil.rmtree(chunk['process_dir'], ignore_errors=True)
+        print(f"Dropped chunk {chunk['chunk_id']} and removed {chunk['process_dir']}")
+    return drop
+
+async def produce_chunks(chunk_queue, slots):
+    """ queues any resumable chunks, then claims new ones for the download stage until no new areas are available.
+    each chunk takes one of the PREFETCH_DEPTH slots before it is claimed (or resumed) and holds it until it
+    reaches pullauta, so that is the bound on leases held and chunks downloaded ahead of pullauta
+    """
+    for chunk in await asyncio.to_thread(resume_chunks):
+        await slots.acquire()
+        chunk['_holds_slot'] = True
+        await chunk_queue.put(chunk)
 
-    tasks = [process_chunk(chunk['chunk_id'],chunk['xmin'],chunk['ymin'],chunk['file_list'],chunk['area_name'],download_semaphore,pullauta_semaphore) for chunk in chunks]
-    await asyncio.gather(*tasks)
+    while True:
+        await slots.acquire()
+        chunk = await asyncio.to_thread(claim_chunk)
+        if chunk is None:
+            slots.release()
+            break
+        print(f"Claimed chunk {chunk['chunk_id']}")
+        chunk = start_chunk(chunk)
+        chunk['_holds_slot'] = True
+        await chunk_queue.put(chunk)
+
+    await chunk_queue.put(STOP)
+
+async def main():
+    """Main function - a long running pipeline which keeps claiming and processing chunks."""
+    # created here rather than at import, so it belongs to the running event loop
+    slots = asyncio.Semaphore(PREFETCH_DEPTH)
+    stages = [
+        ('download', checkpointed('download', stage_download, ['downloaded_files', 'tiles']), STAGE_WORKERS['download']),
+        ('index', checkpointed('index', stage_index, ['downloaded_files', 'tiles']), STAGE_WORKERS['index']),
+        ('pullauta', entering_pullauta(checkpointed('pullauta', stage_pullauta, ['output']), slots), STAGE_WORKERS['pullauta']),
+        ('tile', stage_tile, STAGE_WORKERS['tile']),
+        ('upload', checkpointed('upload', stage_upload, []), STAGE_WORKERS['upload']),
+        ('zooms', stage_zooms, STAGE_WORKERS['zooms']),
+    ]
+    # every queue is a single slot handover - how far the chunks run ahead of pullauta is bounded by the slots
+    queue_sizes = [1, 1, 1, 1, 1, 1]
 
-if __name__ == "__main__":
-    async def process_all_chunks():
-        if os.path.exists("process"):
-            shutil.rmtree("process")
+    await run_pipeline(functools.partial(produce_chunks, slots=slots), stages, queue_sizes, on_failure=dropping_chunk(slots))
 
-        
-        if SPECIFIED_AREA is not None:
-            payload = {
-                "area_name": SPECIFIED_AREA
-            }
-            # eg "area_name": "NZ20_Hawkes"
-
-            r = requests.post("https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/new_area_specific",json=payload)
-
-        else:
-            r = requests.post("https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/new_area_specific")
-
-        if r.status_code == 200:
-            returned_json = json.loads(r.json()["body"])
-            area_uuid = returned_json["uuid"]
-            file_list = returned_json["files"]
-            xmin = int(returned_json["xmin"])
-            if xmin // 5000 != xmin / 5000:
-                xmin_diff = xmin % 5000
-                if (xmin + xmin_diff) // 5000 != (xmin + xmin_diff) / 5000:
-                    xmin_diff = -xmin_diff
-                xmin = int(np.round(xmin + xmin_diff))
-                
-            ymin = int(returned_json["ymin"])
-            if ymin // 5000 != ymin / 5000:
-                ymin_diff = ymin % 5000
-                if (ymin + ymin_diff) // 5000 != (ymin + ymin_diff) / 5000:
-                    ymin_diff = -ymin_diff
-                ymin = int(np.round(ymin + ymin_diff))
-
-            overwrite = returned_json['overwrite']
-            area_name = returned_json['area_name'] if 'area_name' in returned_json else 'LEGACY'
-            chunk_1 = {"chunk_id": area_uuid, "xmin": xmin, "ymin": ymin, "file_list": file_list, 'overwrite': overwrite, 'area_name': area_name}
-
-            if SPECIFIED_AREA is not None:
-                payload = {
-                    "area_name": SPECIFIED_AREA
-                }
-                # eg "area_name": "NZ20_Hawkes"
-
-                r2 = requests.post("https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/new_area_specific",json=payload)
-
-            else:
-                r2 = requests.post("https://fcghgojd5l.execute-api.us-east-2.amazonaws.com/dev/new_area_specific")
-
-            if r2.status_code == 200:
-                returned_json = json.loads(r2.json()["body"])
-                area_uuid = returned_json["uuid"]
-                file_list = returned_json["files"]
-                xmin = int(returned_json["xmin"])
-                ymin = int(returned_json["ymin"])
-                overwrite = returned_json['overwrite']
-                area_name = returned_json['area_name'] if 'area_name' in returned_json else 'LEGACY'
-                chunk_2 = {"chunk_id": area_uuid, "xmin": xmin, "ymin": ymin, "file_list": file_list, 'overwrite': overwrite, 'area_name': area_name}
-                
-
-                await main([chunk_1, chunk_2])
-            
-            else:
-                await main([chunk_1])
-            
-        else:
-            raise Exception("No new areas available")
-
-    # Create the loop once
-    while True:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(process_all_chunks())
\ No newline at end of file
+if __name__ == "__main__":
+    # chunks left in "process" by an interrupted run are resumed rather than removed
+    asyncio.run(main())
+    raise Exception("No new areas available")